@@ -1,23 +1,41 @@
 /*
 Simple Ethernet wrapper for the IBIS protocol.
 (C) 2015 Julian Metzler
+
+Texts are received as frames terminated by a newline, so a client can keep
+its connection open and send many texts. Data that is left over when the
+client disconnects is treated as a frame as well (for older clients).
+Frames longer than the message buffer are truncated.
+
+Only one client is served at a time, but between frames the gateway switches
+to any other connection that has sent data and closes the idle one, so an open
+connection can't keep other senders out. Clients that don't send anything for
+CLIENT_TIMEOUT are disconnected as well (e.g. if they vanished without closing
+the connection).
 */
 
 #include <SPI.h>
 #include <Ethernet.h>
 
 #define REFRESH_TIMEOUT 120000 // Two minutes
+#define MESSAGE_SIZE 150
+#define CLIENT_TIMEOUT 30000 // 30 seconds
 
 byte ETH_MAC[] = {0xC0, 0xFF, 0xEE, 0xC0, 0xFF, 0xEE};
 short ETH_PORT = 1337;
 
 EthernetServer ibisServer(ETH_PORT);
-char currentText[150];
-int lastRefresh = millis();
+EthernetClient client;
+char currentText[MESSAGE_SIZE];
+char message[MESSAGE_SIZE];
+short messagePos = 0;
+unsigned long lastRefresh = millis();
+unsigned long lastActivity = 0;
 
 void sendIBIS003c(char* text) {
   strcpy(currentText, text);
-  char datagram[150], datagramFormat[10];
+  // Header, text padded to full blocks, CR and NUL
+  char datagram[MESSAGE_SIZE + 10], datagramFormat[16];
   short length = strlen(text);
   short blocks = length / 4;
   short remainder = length % 4;
@@ -62,24 +80,58 @@ void setup() {
   sendIBIS003c(ipText);
 }
 
+void processMessage() {
+  // Send the message to the display
+  message[messagePos] = 0;
+  sendIBIS003c(message);
+  messagePos = 0;
+}
+
+void readClient() {
+  if(client.available() > 0) {
+    lastActivity = millis();
+  }
+  
+  while(client.available() > 0) {
+    // Read data, dropping everything that doesn't fit into the buffer
+    char thisChar = client.read();
+    if(thisChar == '\n') {
+      processMessage();
+    } else if(thisChar != '\r' && messagePos < MESSAGE_SIZE - 1) {
+      message[messagePos++] = thisChar;
+    }
+  }
+}
+
+void closeClient() {
+  // Process whatever the client sent before disconnecting
+  readClient();
+  if(messagePos > 0) {
+    processMessage();
+  }
+  client.stop();
+}
+
 void loop() {
-  // Wait for connection
-  EthernetClient client = ibisServer.available();
-  if(client) {
-    char message[150] = {0};
-    short messagePos = 0;
-    while(client.connected()) {
-      if(client.available() > 0) {
-        // Read data
-        char thisChar = client.read();
-        message[messagePos] = thisChar;
-        messagePos++;
+  if(client && (!client.connected() || millis() - lastActivity >= CLIENT_TIMEOUT)) {
+    closeClient();
+  }
+  
+  // Between frames, serve any connection that has sent data
+  if(messagePos == 0) {
+    EthernetClient newClient = ibisServer.available();
+    if(newClient && !(newClient == client)) {
+      if(client) {
+        client.stop();
       }
+      client = newClient;
+      lastActivity = millis();
     }
-    
-    // Send the message to the display
-    sendIBIS003c(message);
-  } else {
-    preventTimeout();
   }
+  
+  if(client) {
+    readClient();
+  }
+  
+  preventTimeout();
 }
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Julian Metzler
+# See the LICENSE file for the full license.
+
+"""
+Stress test for the thread safety of the Controller
+
+Several threads call set_message (and set_enabled) as fast as they can while
+another thread runs the tick loop. Output goes to the virtual IBIS bus.
+Afterwards, all telegrams are checked and the saved configuration is compared
+with the state of the controller.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import ibis
+from ibis.ibis_server import Controller
+
+# Every display gets its own letter, so telegrams that end up on the wrong display can be detected
+LETTERS = "ABCD"
+NEUTRAL = set(" 0123456789:")
+
+def make_text(rand, address):
+	return LETTERS[address] * rand.randint(1, 8) + " %i" % rand.randint(0, 999)
+
+def make_message(rand, address):
+	kind = rand.choice(('text', 'sequence', 'sequence', 'ticker', 'time'))
+	if kind == 'text':
+		return {'type': 'text', 'text': make_text(rand, address)}
+	elif kind == 'ticker':
+		return {'type': 'ticker', 'text': make_text(rand, address), 'length': 10}
+	elif kind == 'time':
+		return {'type': 'time', 'format': LETTERS[address] + " %H:%M:%S"}
+	
+	# Sequences of different lengths that advance on every tick provoke torn reads
+	messages = [{'type': 'text', 'text': make_text(rand, address)} for index in range(rand.randint(1, 10))]
+	return {'type': 'sequence', 'messages': messages, 'interval': 0.0}
+
+def is_routed_correctly(address, text):
+	return all(char == LETTERS[address] or char in NEUTRAL for char in text)
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-t', '--duration', type = float, default = 10.0, help = "Test duration in seconds")
+	parser.add_argument('-n', '--threads', type = int, default = 8, help = "Number of threads calling set_message")
+	parser.add_argument('-s', '--seed', type = int, default = 0)
+	args = parser.parse_args()
+	
+	# The controller persists its state into the working directory
+	workdir = tempfile.mkdtemp(prefix = "ibis-stress-")
+	old_cwd = os.getcwd()
+	os.chdir(workdir)
+	
+	master = ibis.IBISMaster("ibisbus://controller-stress")
+	bus = master.device.bus
+	controller = Controller(master)
+	
+	errors = []
+	counts = {'set_message': 0, 'rejected': 0, 'set_enabled': 0, 'ticks': 0}
+	counts_lock = threading.Lock()
+	end = time.time() + args.duration
+	
+	def _record_error():
+		with counts_lock:
+			errors.append(traceback.format_exc())
+	
+	def _tick_loop():
+		while time.time() < end:
+			try:
+				controller.tick()
+			except Exception:
+				_record_error()
+			with counts_lock:
+				counts['ticks'] += 1
+	
+	def _writer(index):
+		rand = random.Random(args.seed + index)
+		while time.time() < end:
+			address = rand.randint(0, 3)
+			try:
+				if rand.random() < 0.05:
+					controller.set_enabled(address, rand.random() < 0.8)
+					key = 'set_enabled'
+				else:
+					success = controller.set_message(address, make_message(rand, address), priority = rand.randint(0, 2), client = "writer-%i" % index)
+					key = 'set_message' if success else 'rejected'
+			except Exception:
+				_record_error()
+				continue
+			with counts_lock:
+				counts[key] += 1
+	
+	threads = [threading.Thread(target = _tick_loop)]
+	threads += [threading.Thread(target = _writer, args = (index, )) for index in range(args.threads)]
+	start = time.time()
+	try:
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		
+		# The last saved configuration must match what the controller has now
+		try:
+			with open("ibis.json", 'r') as f:
+				saved = json.loads(f.read())
+			config_ok = all(saved['buffer'][str(address)]['message'] == controller.buffer[address]['message'] for address in range(4))
+		except ValueError:
+			config_ok = False
+	finally:
+		os.chdir(old_cwd)
+		shutil.rmtree(workdir, ignore_errors = True)
+	elapsed = time.time() - start
+	
+	# Every telegram must be valid and belong to the display it was sent to
+	misrouted = 0
+	for address in range(4):
+		for telegram in bus.get_telegrams(address):
+			if not is_routed_correctly(address, telegram.data[3:]):
+				misrouted += 1
+	stats = bus.get_stats()
+	
+	print "%(set_message)i messages set, %(rejected)i rejected, %(set_enabled)i power changes, %(ticks)i ticks" % counts
+	print "%.0f requests/s, %.0f ticks/s" % ((counts['set_message'] + counts['rejected'] + counts['set_enabled']) / elapsed, counts['ticks'] / elapsed)
+	print "%i telegrams, %i misrouted, %i checksum errors, %i framing errors" % (sum(stats['telegrams'].values()), misrouted, stats['checksum_errors'], stats['framing_errors'])
+	print "%i exceptions, saved configuration %s" % (len(errors), "consistent" if config_ok else "INCONSISTENT")
+	for error in errors[:5]:
+		print error
+	
+	if errors or misrouted or not config_ok or stats['checksum_errors'] or stats['framing_errors']:
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
\ No newline at end of file
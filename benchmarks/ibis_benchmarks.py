@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Julian Metzler
+# See the LICENSE file for the full license.
+
+"""
+Benchmark suite for the hot paths of pyIBIS
+
+Everything runs offline: serial output goes to the virtual IBIS bus
+(ibisbus://, using its virtual clock so no time is spent waiting for the
+1200 baud line) and the server is started on a free localhost port.
+Results are printed and can be written to a JSON file for comparison
+across releases.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import socket
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import ibis
+from ibis.ibis_tracing import percentile
+from ibis.ibis_utils import _receive_datagram, _send_datagram, prepare_text
+
+FONT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulation-font")
+
+BENCHMARKS = []
+
+def benchmark(name):
+	def _register(func):
+		BENCHMARKS.append((name, func))
+		return func
+	return _register
+
+def measure(func, number, repeat = 5):
+	"""
+	Run <func> <number> times per round for <repeat> rounds and return
+	timing statistics per call in microseconds
+	"""
+	
+	timings = []
+	for i in range(repeat):
+		start = timeit.default_timer()
+		for j in xrange(number):
+			func()
+		timings.append((timeit.default_timer() - start) / number)
+	
+	timings.sort()
+	return {
+		'calls': number * repeat,
+		'min_us': timings[0] * 1e6,
+		'median_us': percentile(timings, 0.5) * 1e6,
+		'max_us': timings[-1] * 1e6,
+		'ops_per_s': 1.0 / timings[0] if timings[0] else None,
+	}
+
+def get_free_port():
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.bind(('127.0.0.1', 0))
+	port = sock.getsockname()[1]
+	sock.close()
+	return port
+
+def load_fonts():
+	return (
+		ibis.simulation.DisplayFont(os.path.join(FONT_DIR, "bold", ".fontmap"), spacing = 2),
+		ibis.simulation.DisplayFont(os.path.join(FONT_DIR, "bold", ".fontmap"), spacing = 1),
+		ibis.simulation.DisplayFont(os.path.join(FONT_DIR, "narrow", ".fontmap"), spacing = 2),
+		ibis.simulation.DisplayFont(os.path.join(FONT_DIR, "narrow", ".fontmap"), spacing = 1),
+	)
+
+@benchmark('protocol.send_next_stop__003c')
+def bench_encode_003c(args):
+	master = ibis.IBISMaster("ibisbus://benchmark-encode")
+	return measure(lambda: master.send_next_stop__003c(u"Frankfurt (Main) Hauptbahnhof"), args.number)
+
+@benchmark('protocol.send_target_text__021t')
+def bench_encode_021t(args):
+	master = ibis.IBISMaster("ibisbus://benchmark-encode")
+	texts = [(u"Frankfurt (Main)", u"Hauptbahnhof"), (u"über Mainz", u"und Wiesbaden")]
+	return measure(lambda: master.send_target_text__021t(texts, 1, 2), args.number)
+
+@benchmark('utils.prepare_text')
+def bench_prepare_text(args):
+	return measure(lambda: prepare_text(u"Nächster Halt: Düsseldorf Straße"), args.number * 10)
+
+@benchmark('utils.datagram_round_trip')
+def bench_datagram_round_trip(args):
+	sender, receiver = socket.socketpair()
+	message = {'address': 0, 'message': {'type': 'text', 'text': "Hello world"}, 'priority': 0}
+	
+	def _round_trip():
+		_send_datagram(sender, message)
+		_receive_datagram(receiver)
+	
+	try:
+		return measure(_round_trip, args.number)
+	finally:
+		sender.close()
+		receiver.close()
+
+@benchmark('server.listener_throughput')
+def bench_listener_throughput(args):
+	port = get_free_port()
+	server = ibis.Server("ibisbus://benchmark-server", port = port)
+	for target in (server.controller.run, server.listener.run):
+		thread = threading.Thread(target = target)
+		thread.daemon = True
+		thread.start()
+	time.sleep(0.2)
+	
+	results = {}
+	try:
+		for concurrency in args.concurrency:
+			latencies = []
+			errors = [0]
+			lock = threading.Lock()
+			
+			def _worker(index):
+				client = ibis.Client("127.0.0.1", port)
+				for i in range(args.requests):
+					start = timeit.default_timer()
+					try:
+						reply = client.set_text(index % 4, u"Client %i request %i" % (index, i))
+						ok = reply and reply.get('success')
+					except Exception:
+						ok = False
+					duration = timeit.default_timer() - start
+					with lock:
+						latencies.append(duration)
+						if not ok:
+							errors[0] += 1
+			
+			start = timeit.default_timer()
+			threads = [threading.Thread(target = _worker, args = (index, )) for index in range(concurrency)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+			elapsed = timeit.default_timer() - start
+			
+			latencies.sort()
+			results['concurrency_%i' % concurrency] = {
+				'requests': len(latencies),
+				'errors': errors[0],
+				'requests_per_s': len(latencies) / elapsed,
+				'p50_ms': percentile(latencies, 0.50) * 1000.0,
+				'p95_ms': percentile(latencies, 0.95) * 1000.0,
+				'p99_ms': percentile(latencies, 0.99) * 1000.0,
+			}
+	finally:
+		server.controller.running = False
+		server.listener.running = False
+	
+	return results
+
+@benchmark('server.controller_tick')
+def bench_controller_tick(args):
+	# The controller drives four displays; give all of them a long sequence
+	# that advances on every tick so each tick sends to every display
+	master = ibis.IBISMaster("ibisbus://benchmark-controller")
+	controller = ibis.ibis_server.Controller(master)
+	sequence = {
+		'type': 'sequence',
+		'messages': [{'type': 'text', 'text': u"Message %i" % i} for i in range(100)] + [{'type': 'time', 'format': "%H:%M:%S"}],
+		'interval': 0.0,
+	}
+	for address in range(4):
+		controller.set_message(address, dict(sequence), priority = 0, client = "benchmark")
+	
+	results = {'sending': measure(controller.tick, args.number // 10 or 1)}
+	
+	# Static texts that are already displayed, i.e. the cost of an idle tick
+	for address in range(4):
+		controller.set_message(address, {'type': 'text', 'text': u"Static %i" % address}, priority = 0, client = "benchmark")
+	controller.tick()
+	results['idle'] = measure(controller.tick, args.number)
+	return results
+
+@benchmark('simulation.generate_image')
+def bench_generate_image(args):
+	simulator = ibis.simulation.DisplaySimulator(load_fonts(), width = 120, height = 8)
+	results = {}
+	for dotsize, dotspacing in ((1, 0), (5, 2), (47, 8)):
+		number = max(1, args.number // (10 * dotsize))
+		results['dotsize_%i' % dotsize] = measure(lambda: simulator.generate_image(u"Frankfurt (Main) Hbf", StringIO.StringIO(), dotsize = dotsize, dotspacing = dotspacing), number, repeat = 3)
+	return results
+
+@benchmark('simulation.dot_rendering')
+def bench_dot_rendering(args):
+	# Compare drawing every dot as an ellipse with tiling pre-rendered sprites
+	simulator = ibis.simulation.DisplaySimulator(load_fonts(), width = 120, height = 8)
+	overflow, dots = simulator.render(u"Frankfurt (Main) Hbf")
+	char_data = {'width': 120, 'height': 8, 'dots': dots}
+	colors = ((64, 64, 64), (192, 255, 0), (0, 0, 0))
+	results = {}
+	for dotsize, dotspacing in ((3, 1), (5, 2), (10, 2), (47, 8)):
+		generator = ibis.simulation.DisplayFontGenerator(dotsize, dotspacing)
+		number = max(1, args.number // (10 * dotsize))
+		results['dotsize_%i' % dotsize] = {
+			'ellipses': measure(lambda: generator.draw_image_ellipses(char_data, *colors), number, repeat = 3),
+			'sprites': measure(lambda: generator.draw_image(char_data, *colors), number, repeat = 3),
+		}
+	return results
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-o', '--output', type = str, help = "Write the results to this JSON file")
+	parser.add_argument('-f', '--filter', type = str, help = "Only run benchmarks whose name contains this string")
+	parser.add_argument('-n', '--number', type = int, default = 1000, help = "Base number of calls per round")
+	parser.add_argument('-r', '--requests', type = int, default = 50, help = "Requests per client in the listener benchmark")
+	parser.add_argument('-c', '--concurrency', type = int, nargs = '+', default = [1, 4, 16])
+	args = parser.parse_args()
+	
+	# The server and controller persist their state into the working directory,
+	# so every benchmark gets a fresh one
+	workdir = tempfile.mkdtemp(prefix = "ibis-benchmark-")
+	old_cwd = os.getcwd()
+	
+	results = {}
+	try:
+		for name, func in BENCHMARKS:
+			if args.filter and args.filter not in name:
+				continue
+			os.chdir(tempfile.mkdtemp(dir = workdir))
+			print "Running %s..." % name
+			sys.stdout.flush()
+			results[name] = func(args)
+			print json.dumps(results[name], indent = 4, sort_keys = True)
+	finally:
+		os.chdir(old_cwd)
+		shutil.rmtree(workdir, ignore_errors = True)
+	
+	report = {
+		'version': ibis.__version__,
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'timestamp': datetime.datetime.utcnow().isoformat(),
+		'arguments': vars(args),
+		'results': results,
+	}
+	
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(report, f, indent = 4, sort_keys = True)
+
+if __name__ == "__main__":
+	main()
\ No newline at end of file
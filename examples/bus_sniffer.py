@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Julian Metzler
+# See the LICENSE file for the full license.
+
+"""
+Script to listen on an IBIS bus (or read a capture file) and print the decoded telegrams
+as well as the rate of each telegram type and the number of errors
+"""
+
+import argparse
+import collections
+import ibis
+import serial
+import sys
+import time
+
+def print_stats(counts, decoder, elapsed):
+	print "--- %.1f s ---" % elapsed
+	for type, count in sorted(counts.iteritems()):
+		print "%-20s %8i  %8.2f/s" % (type, count, count / elapsed if elapsed else 0.0)
+	print "%-20s %8i" % ("checksum errors", decoder.checksum_errors)
+	print "%-20s %8i" % ("overflow errors", decoder.overflow_errors)
+	sys.stdout.flush()
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-sp', '--serial-port', type = str, default = "/dev/ttyUSB0")
+	parser.add_argument('-f', '--file', type = str, help = "Read from a capture file instead of the serial port")
+	parser.add_argument('-i', '--interval', type = float, default = 10.0, help = "How often to print statistics (seconds)")
+	parser.add_argument('-q', '--quiet', action = 'store_true', help = "Only print statistics, not every telegram")
+	args = parser.parse_args()
+	
+	if args.file:
+		stream = open(args.file, 'rb')
+	else:
+		stream = serial.serial_for_url(
+			args.serial_port,
+			baudrate = 1200,
+			bytesize = serial.SEVENBITS,
+			parity = serial.PARITY_EVEN,
+			stopbits = serial.STOPBITS_TWO,
+			timeout = 0.5
+		)
+	
+	decoder = ibis.TelegramDecoder()
+	counts = collections.Counter()
+	start = last_stats = time.time()
+	
+	try:
+		while True:
+			data = stream.read(64)
+			if not data and args.file:
+				break
+			
+			for telegram in decoder.feed(data):
+				counts[telegram.type] += 1
+				if args.quiet:
+					continue
+				
+				flag = "" if telegram.valid else " [CHECKSUM ERROR]"
+				print "%.3f %-20s %r%s" % (time.time() - start, telegram.type, telegram.fields or telegram.data, flag)
+			
+			now = time.time()
+			if now - last_stats >= args.interval:
+				print_stats(counts, decoder, now - start)
+				last_stats = now
+	except KeyboardInterrupt:
+		pass
+	finally:
+		stream.close()
+	
+	print_stats(counts, decoder, time.time() - start)
+
+if __name__ == "__main__":
+	main()
\ No newline at end of file
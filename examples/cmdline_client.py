@@ -15,7 +15,7 @@ def main():
 	parser.add_argument('-host', '--host', type = str, default = "localhost")
 	parser.add_argument('-p', '--port', type = int, default = 4242)
 	parser.add_argument('-d', '--display', type = int, choices = [0, 1, 2, 3])
-	parser.add_argument('-t', '--type', choices = ['text', 'time', 'sequence'])
+	parser.add_argument('-t', '--type', choices = ['text', 'time', 'sequence', 'ticker'])
 	parser.add_argument('-v', '--value', type = str)
 	parser.add_argument('-pr', '--priority', type = int, default = 0)
 	parser.add_argument('-c', '--client', type = str)
@@ -46,6 +46,8 @@ def main():
 		client.set_text(args.display, args.value, priority = args.priority, client = args.client)
 	elif args.type == 'time':
 		client.set_time(args.display, args.value, priority = args.priority, client = args.client)
+	elif args.type == 'ticker':
+		client.set_ticker(args.display, args.value, priority = args.priority, client = args.client)
 	elif args.type == 'sequence':
 		sequence = []
 		items = args.value.split("|")
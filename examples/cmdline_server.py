@@ -9,6 +9,26 @@ Example command-line script that uses the IBIS server
 
 import argparse
 import ibis
+import os
+import signal
+import sys
+
+FONT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulation-font")
+
+def get_profiles():
+	"""
+	Build layout profiles for four displays that use the font in the simulation-font folder
+	"""
+	
+	fonts = (
+		ibis.simulation.DisplayFont(os.path.join(FONT_DIR, "bold", ".fontmap"), spacing = 2),
+		ibis.simulation.DisplayFont(os.path.join(FONT_DIR, "bold", ".fontmap"), spacing = 1),
+		ibis.simulation.DisplayFont(os.path.join(FONT_DIR, "narrow", ".fontmap"), spacing = 2),
+		ibis.simulation.DisplayFont(os.path.join(FONT_DIR, "narrow", ".fontmap"), spacing = 1),
+	)
+	fitter = ibis.layout.TextFitter(ibis.simulation.DisplaySimulator(fonts, width = 120, height = 8))
+	profile = ibis.layout.DisplayProfile(fitter, telegram = 'next_stop__003c')
+	return dict((address, profile) for address in range(4))
 
 def main():
 	parser = argparse.ArgumentParser()
@@ -18,6 +38,12 @@ def main():
 	parser.add_argument('-t', '--timeout', type = int, default = 120)
 	parser.add_argument('-sp', '--serial-port', type = str, default = "/dev/ttyUSB0")
 	parser.add_argument('-p', '--port', type = int, default = 4242)
+	parser.add_argument('-tr', '--trace', action = 'store_true')
+	parser.add_argument('-bp', '--bus-process', action = 'store_true', help = "Drive the serial port from a separate process")
+	parser.add_argument('-l', '--layout', action = 'store_true', help = "Abbreviate or split texts that don't fit on the displays")
+	parser.add_argument('-lj', '--log-json', action = 'store_true', help = "Write log messages as JSON lines")
+	parser.add_argument('-j', '--journal', action = 'store_true', help = "Append changes to a journal instead of rewriting ibis.json every time")
+	parser.add_argument('-sf', '--status-file', type = str, help = "Publish the status of the displays to this file (e.g. /dev/shm/ibis-status)")
 	args = parser.parse_args()
 	
 	gpio_pinmap = {
@@ -27,7 +53,10 @@ def main():
 		3: 30
 	}
 	
-	server = ibis.Server(args.serial_port, port = args.port, timeout = args.timeout, gpio_pinmap = gpio_pinmap, verbose = args.verbose, debug = args.debug, selftest = args.selftest)
+	server = ibis.Server(args.serial_port, port = args.port, timeout = args.timeout, gpio_pinmap = gpio_pinmap, verbose = args.verbose, debug = args.debug, selftest = args.selftest, trace = args.trace, profiles = get_profiles() if args.layout else None, bus_process = args.bus_process, log_json = args.log_json, journal = args.journal, status_file = args.status_file)
+	
+	# Shut down cleanly (see Server.close) when stopped by a service manager
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 	server.run()
 
 if __name__ == "__main__":
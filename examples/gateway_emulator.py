@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2015 Julian Metzler
+# See the LICENSE file for the full license.
+
+"""
+Script to emulate an EthernetIBIS gateway, e.g. to test or benchmark EthernetWrapper without the hardware
+"""
+
+import argparse
+import ibis
+import time
+
+from ibis.ibis_gateway import EthernetGateway
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-host', '--host', type = str, default = "127.0.0.1")
+	parser.add_argument('-p', '--port', type = int, default = 1337)
+	parser.add_argument('-o', '--output', type = str, default = "ibisbus://gateway", help = "The serial port (or URL) to write the telegrams to")
+	parser.add_argument('-c', '--capture', type = str, help = "Write the telegrams to this capture file instead (can be read by bus_sniffer.py -f)")
+	parser.add_argument('-l', '--latency', type = float, default = 0.0, help = "Additional processing time per message in seconds")
+	parser.add_argument('-st', '--serial-timing', action = 'store_true', help = "Wait for every telegram to be transmitted at 1200 baud")
+	parser.add_argument('-lg', '--legacy', action = 'store_true', help = "Behave like the old sketch (one message per connection, no frames)")
+	parser.add_argument('-i', '--interval', type = float, default = 10.0, help = "Interval between statistics reports in seconds")
+	args = parser.parse_args()
+	
+	output = open(args.capture, 'ab') if args.capture else args.output
+	gateway = EthernetGateway(output, host = args.host, port = args.port, latency = args.latency, serial_timing = args.serial_timing, framed = not args.legacy)
+	gateway.start()
+	print "Listening on %s:%i" % (args.host, gateway.port)
+	
+	try:
+		while True:
+			time.sleep(args.interval)
+			stats = gateway.get_stats()
+			print "%(messages)i messages, %(connections)i connections, %(overflows)i overflows, %(refreshes)i refreshes, %(bytes)i bytes" % stats
+	except KeyboardInterrupt:
+		pass
+	finally:
+		gateway.stop()
+
+if __name__ == "__main__":
+	main()
\ No newline at end of file
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Julian Metzler
+# See the LICENSE file for the full license.
+
+"""
+Script to put load on an IBIS server using a number of concurrent virtual clients
+and report the achieved throughput, errors and latencies
+"""
+
+import argparse
+import collections
+import ibis
+import json
+import random
+import threading
+import time
+
+from ibis.ibis_tracing import percentile
+
+OPERATIONS = ('set_text', 'set_sequence', 'set_time', 'query')
+
+def parse_mix(mix):
+	"""
+	Parse a mix like "set_text=5,query=1" into a list of (operation, weight) tuples
+	"""
+	
+	weights = []
+	for item in mix.split(","):
+		operation, weight = item.split("=")
+		if operation not in OPERATIONS:
+			raise ValueError("Unknown operation: %s" % operation)
+		weights.append((operation, float(weight)))
+	return weights
+
+def choose(weights, rand):
+	value = rand.uniform(0, sum(weight for operation, weight in weights))
+	for operation, weight in weights:
+		value -= weight
+		if value <= 0:
+			return operation
+	return weights[-1][0]
+
+class VirtualClient(threading.Thread):
+	def __init__(self, index, args, weights, stats):
+		super(VirtualClient, self).__init__()
+		self.daemon = True
+		self.index = index
+		self.args = args
+		self.weights = weights
+		self.stats = stats
+		self.name = "load-client-%i" % index
+		self.client = ibis.Client(args.host, args.port, timeout = args.timeout)
+		self.rand = random.Random(args.seed + index)
+	
+	def do_request(self, operation):
+		address = self.rand.choice(self.args.displays)
+		priority = self.rand.randint(0, self.args.max_priority)
+		text = u"%s #%i" % (self.name, self.rand.randint(0, 9999))
+		
+		if operation == 'set_text':
+			return self.client.set_text(address, text, priority = priority, client = self.name)
+		elif operation == 'set_time':
+			return self.client.set_time(address, "%H:%M:%S", priority = priority, client = self.name)
+		elif operation == 'set_sequence':
+			sequence = [self.client.make_text(text, 2.0), self.client.make_time("%H:%M")]
+			return self.client.set_sequence(address, sequence, 5.0, priority = priority, client = self.name)
+		else:
+			return self.client.get_all()
+	
+	def run(self):
+		interval = 1.0 / self.args.rate if self.args.rate else 0.0
+		next_request = time.time() + self.rand.uniform(0, interval)
+		end = time.time() + self.args.duration
+		
+		while time.time() < end:
+			delay = next_request - time.time()
+			if delay > 0:
+				time.sleep(delay)
+			next_request += interval
+			
+			operation = choose(self.weights, self.rand)
+			start = time.time()
+			try:
+				reply = self.do_request(operation)
+				if reply is None:
+					outcome = 'invalid_reply'
+				elif operation != 'query' and not reply.get('success'):
+					# The controller rejects messages with a lower priority than the current one
+					outcome = 'rejected'
+				else:
+					outcome = 'ok'
+			except Exception as e:
+				outcome = type(e).__name__
+			self.stats.record(operation, outcome, time.time() - start)
+
+class Stats(object):
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.latencies = collections.defaultdict(list)
+		self.outcomes = collections.Counter()
+	
+	def record(self, operation, outcome, latency):
+		with self.lock:
+			self.latencies[operation].append(latency)
+			self.outcomes[(operation, outcome)] += 1
+	
+	def report(self, elapsed):
+		report = {'elapsed': elapsed, 'operations': {}}
+		total = 0
+		for operation, latencies in self.latencies.iteritems():
+			latencies.sort()
+			total += len(latencies)
+			report['operations'][operation] = {
+				'requests': len(latencies),
+				'outcomes': dict((outcome, count) for (op, outcome), count in self.outcomes.iteritems() if op == operation),
+				'p50_ms': percentile(latencies, 0.50) * 1000.0,
+				'p95_ms': percentile(latencies, 0.95) * 1000.0,
+				'p99_ms': percentile(latencies, 0.99) * 1000.0,
+				'max_ms': latencies[-1] * 1000.0,
+			}
+		report['requests'] = total
+		report['throughput'] = total / elapsed if elapsed else 0.0
+		report['errors'] = sum(count for (op, outcome), count in self.outcomes.iteritems() if outcome not in ('ok', 'rejected'))
+		report['rejected'] = sum(count for (op, outcome), count in self.outcomes.iteritems() if outcome == 'rejected')
+		return report
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-host', '--host', type = str, default = "localhost")
+	parser.add_argument('-p', '--port', type = int, default = 4242)
+	parser.add_argument('-n', '--clients', type = int, default = 4, help = "Number of concurrent virtual clients")
+	parser.add_argument('-r', '--rate', type = float, default = 1.0, help = "Target requests per second per client (0 = as fast as possible)")
+	parser.add_argument('-t', '--duration', type = float, default = 30.0, help = "Test duration in seconds")
+	parser.add_argument('-m', '--mix', type = str, default = "set_text=6,set_sequence=1,set_time=1,query=2", help = "Weighted mix of operations")
+	parser.add_argument('-d', '--displays', type = int, nargs = '+', default = [0, 1, 2, 3])
+	parser.add_argument('-mp', '--max-priority', type = int, default = 0, help = "Use random priorities up to this value (provokes rejections)")
+	parser.add_argument('-to', '--timeout', type = float, default = 5.0)
+	parser.add_argument('-s', '--seed', type = int, default = 0)
+	parser.add_argument('-j', '--json', action = 'store_true', help = "Print the report as JSON")
+	args = parser.parse_args()
+	
+	weights = parse_mix(args.mix)
+	stats = Stats()
+	clients = [VirtualClient(index, args, weights, stats) for index in range(args.clients)]
+	
+	start = time.time()
+	for client in clients:
+		client.start()
+	try:
+		for client in clients:
+			while client.is_alive():
+				client.join(0.5)
+	except KeyboardInterrupt:
+		pass
+	report = stats.report(time.time() - start)
+	
+	if args.json:
+		print json.dumps(report, indent = 4, sort_keys = True)
+		return
+	
+	print "%i requests in %.1f s (%.1f/s), %i rejected, %i errors" % (report['requests'], report['elapsed'], report['throughput'], report['rejected'], report['errors'])
+	for operation, data in sorted(report['operations'].iteritems()):
+		print "%-14s %6i requests  p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms  max %8.2f ms" % (operation, data['requests'], data['p50_ms'], data['p95_ms'], data['p99_ms'], data['max_ms'])
+		for outcome, count in sorted(data['outcomes'].iteritems()):
+			print "%16s%-12s %6i" % ("", outcome, count)
+
+if __name__ == "__main__":
+	main()
\ No newline at end of file
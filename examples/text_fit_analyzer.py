@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Julian Metzler
+# See the LICENSE file for the full license.
+
+"""
+Script to analyze how a large number of texts (e.g. all station names from a database)
+fit on the display and write the results into an SQLite table that can be queried at runtime
+
+Example:
+	text_fit_analyzer.py -db db_stations.db -t stations -c name -o fit_index.db
+	SELECT font, overflow, abbreviation, pages FROM text_fit WHERE text = 'Frankfurt (Main) Hbf'
+"""
+
+import argparse
+import ibis
+import os
+import sqlite3
+import time
+
+FONT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulation-font")
+
+def read_file(filename):
+	with open(filename, 'r') as f:
+		for line in f:
+			text = line.rstrip("\r\n").decode('utf-8')
+			if text:
+				yield text
+
+def read_database(filename, table, column):
+	db = sqlite3.connect(filename)
+	cur = db.cursor()
+	cur.execute("SELECT `%s` FROM `%s`" % (column, table))
+	while True:
+		rows = cur.fetchmany(10000)
+		if not rows:
+			break
+		for row in rows:
+			if row[0]:
+				yield row[0]
+	db.close()
+
+def chunks(iterable, size):
+	chunk = []
+	for item in iterable:
+		chunk.append(item)
+		if len(chunk) == size:
+			yield chunk
+			chunk = []
+	if chunk:
+		yield chunk
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-f', '--file', type = str, help = "Text file with one text per line")
+	parser.add_argument('-db', '--database', type = str, help = "SQLite database to read the texts from")
+	parser.add_argument('-t', '--table', type = str, default = "stations")
+	parser.add_argument('-c', '--column', type = str, default = "name")
+	parser.add_argument('-o', '--output', type = str, default = "fit_index.db", help = "SQLite database to write the results to")
+	parser.add_argument('-ot', '--output-table', type = str, default = "text_fit")
+	parser.add_argument('-w', '--width', type = int, default = 120, help = "Display width in dots")
+	parser.add_argument('-he', '--height', type = int, default = 8, help = "Display height in dots")
+	parser.add_argument('-cs', '--chunk-size', type = int, default = 10000)
+	args = parser.parse_args()
+	
+	if args.file:
+		texts = read_file(args.file)
+	elif args.database:
+		texts = read_database(args.database, args.table, args.column)
+	else:
+		parser.error("Either a file or a database is required")
+	
+	fonts = (
+		ibis.simulation.DisplayFont(os.path.join(FONT_DIR, "bold", ".fontmap"), spacing = 2),
+		ibis.simulation.DisplayFont(os.path.join(FONT_DIR, "bold", ".fontmap"), spacing = 1),
+		ibis.simulation.DisplayFont(os.path.join(FONT_DIR, "narrow", ".fontmap"), spacing = 2),
+		ibis.simulation.DisplayFont(os.path.join(FONT_DIR, "narrow", ".fontmap"), spacing = 1),
+	)
+	simulator = ibis.simulation.DisplaySimulator(fonts, width = args.width, height = args.height)
+	fitter = ibis.layout.TextFitter(simulator)
+	font_names = dict((id(font), ibis.layout.get_font_name(font)) for font in fonts)
+	
+	output = sqlite3.connect(args.output)
+	output.execute("DROP TABLE IF EXISTS `%s`" % args.output_table)
+	output.execute("CREATE TABLE `%s` (`text` TEXT PRIMARY KEY, `font` TEXT, `width` INTEGER, `overflow` INTEGER, `abbreviation` TEXT, `pages` TEXT)" % args.output_table)
+	
+	start = time.time()
+	count = overflows = abbreviated = split = 0
+	for chunk in chunks(texts, args.chunk_size):
+		rows = []
+		for result in fitter.fit(chunk):
+			pages = "\n".join(result.pages) if result.pages else None
+			rows.append((result.text, font_names[id(result.font)], result.width, int(result.overflow), result.abbreviation, pages))
+			overflows += result.overflow
+			abbreviated += result.abbreviation is not None
+			split += result.pages is not None
+		output.executemany("INSERT OR REPLACE INTO `%s` VALUES (?, ?, ?, ?, ?, ?)" % args.output_table, rows)
+		count += len(chunk)
+	
+	output.execute("CREATE INDEX `%s_overflow` ON `%s` (`overflow`)" % (args.output_table, args.output_table))
+	output.commit()
+	output.close()
+	
+	elapsed = time.time() - start
+	print "%i texts in %.2f s (%.0f/s)" % (count, elapsed, count / elapsed if elapsed else 0.0)
+	print "%i don't fit, %i of them can be abbreviated, %i can be split into pages" % (overflows, abbreviated, split)
+
+if __name__ == "__main__":
+	main()
\ No newline at end of file
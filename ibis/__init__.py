@@ -5,5 +5,9 @@ from .metadata import version as __version__
 from .ibis_protocol import *
 from .ibis_server import Server
 from .ibis_client import Client
-from .ibis_ethernet import EthernetWrapper
-import ibis_simulation as simulation
\ No newline at end of file
+from .ibis_ethernet import EthernetWrapper, GatewayGroup
+from .ibis_bus import VirtualBus
+from .ibis_decoder import Telegram, TelegramDecoder
+from .ibis_status import StatusReader
+import ibis_simulation as simulation
+import ibis_layout as layout
\ No newline at end of file
@@ -0,0 +1,212 @@
+# Copyright (C) 2014 Julian Metzler
+# See the LICENSE file for the full license.
+
+"""
+Virtual IBIS bus for testing and benchmarking without hardware
+
+Opening the serial URL "ibisbus://<name>" (e.g. by passing it to IBISMaster
+or Server) connects to the VirtualBus with that name. Options:
+	
+	ibisbus://<name>?timing=realtime    Timestamps follow the wall clock
+	ibisbus://<name>?timing=virtual     Timestamps follow a virtual clock which
+	                                    only advances when the master waits for
+	                                    its data to be transmitted (default)
+	ibisbus://<name>?history=<n>        Keep the last <n> telegrams per address
+"""
+
+import collections
+import serial
+import threading
+import time
+
+from .ibis_utils import checksum
+
+# Make the ibisbus:// URL known to serial.serial_for_url
+if 'ibis.urlhandler' not in serial.protocol_handler_packages:
+	serial.protocol_handler_packages.append('ibis.urlhandler')
+
+BusTelegram = collections.namedtuple('BusTelegram', ('timestamp', 'address', 'data', 'valid'))
+
+class VirtualBus(object):
+	"""
+	Decodes everything that's written to it into telegrams and records them
+	per multiplexer address, together with the time at which the last byte
+	of the telegram would have left the wire.
+	
+	The multiplexer address is determined by the DTR and RTS lines just like
+	in Controller.send_text (address = DTR * 2 + RTS).
+	"""
+	
+	buses = {}
+	buses_lock = threading.Lock()
+	
+	@classmethod
+	def get(cls, name, **kwargs):
+		"""
+		Return the bus with the given name, creating it if necessary.
+		Raises ValueError if the bus exists with other options than the given ones.
+		"""
+		
+		with cls.buses_lock:
+			bus = cls.buses.get(name)
+			if bus is None:
+				bus = cls(name, **kwargs)
+				cls.buses[name] = bus
+			
+			for option, value in kwargs.items():
+				if getattr(bus, option) != value:
+					raise ValueError("Bus %s already exists with %s = %r" % (name, option, getattr(bus, option)))
+			return bus
+	
+	@classmethod
+	def remove(cls, name):
+		with cls.buses_lock:
+			cls.buses.pop(name, None)
+	
+	def __init__(self, name, realtime = False, history = None):
+		self.name = name
+		self.realtime = realtime
+		self.history = history
+		self.lock = threading.Lock()
+		self.listeners = []
+		self.reset()
+	
+	def reset(self):
+		"""
+		Clear all recorded telegrams and statistics and restart the clock
+		"""
+		
+		with self.lock:
+			self.epoch = time.time()
+			self.clock = 0.0
+			self.busy_until = 0.0
+			self.dtr = False
+			self.rts = False
+			self.rx_buffer = ""
+			self.rx_address = None
+			self.telegrams = {}
+			self.byte_count = 0
+			self.checksum_errors = 0
+			self.framing_errors = 0
+	
+	def now(self):
+		if self.realtime:
+			return time.time() - self.epoch
+		return self.clock
+	
+	def sleep(self, duration):
+		"""
+		Wait for <duration> seconds on the bus clock
+		"""
+		
+		if self.realtime:
+			time.sleep(duration)
+		else:
+			with self.lock:
+				self.clock += duration
+	
+	def get_address(self):
+		return int(bool(self.dtr)) * 2 + int(bool(self.rts))
+	
+	def set_lines(self, dtr = None, rts = None):
+		with self.lock:
+			if dtr is not None:
+				self.dtr = dtr
+			if rts is not None:
+				self.rts = rts
+	
+	def add_listener(self, callback):
+		"""
+		Register a function that is called with each BusTelegram as it is decoded
+		"""
+		
+		self.listeners.append(callback)
+	
+	def get_byte_time(self, settings):
+		"""
+		Return the time in seconds it takes to transmit one byte
+		with the given (baudrate, bytesize, parity, stopbits) settings
+		"""
+		
+		baudrate, bytesize, parity, stopbits = settings
+		bits = 1 + bytesize + (0 if parity == serial.PARITY_NONE else 1) + stopbits
+		return bits / float(baudrate)
+	
+	def check_settings(self, settings):
+		"""
+		IBIS displays only understand 1200 baud 7E2
+		"""
+		
+		return settings == (1200, serial.SEVENBITS, serial.PARITY_EVEN, serial.STOPBITS_TWO)
+	
+	def write(self, data, settings):
+		"""
+		Put the given data on the bus and decode it
+		"""
+		
+		decoded = []
+		with self.lock:
+			byte_time = self.get_byte_time(settings)
+			start = max(self.now(), self.busy_until)
+			self.busy_until = start + len(data) * byte_time
+			self.byte_count += len(data)
+			
+			if not self.check_settings(settings):
+				# The displays would only receive garbage
+				self.framing_errors += len(data)
+				return decoded
+			
+			for index, char in enumerate(data):
+				if ord(char) > 0x7F:
+					self.framing_errors += 1
+					continue
+				
+				if self.rx_address is None:
+					self.rx_address = self.get_address()
+				
+				if self.rx_buffer.endswith("\r"):
+					# This is the checksum byte
+					timestamp = start + (index + 1) * byte_time
+					decoded.append(self.complete_telegram(timestamp, self.rx_buffer, char))
+				else:
+					self.rx_buffer += char
+		
+		for telegram in decoded:
+			for callback in self.listeners:
+				callback(telegram)
+		
+		return decoded
+	
+	def complete_telegram(self, timestamp, message, check_char):
+		valid = checksum(message) == check_char
+		
+		if not valid:
+			self.checksum_errors += 1
+		
+		telegram = BusTelegram(timestamp, self.rx_address, message[:-1], valid)
+		if self.rx_address not in self.telegrams:
+			self.telegrams[self.rx_address] = collections.deque(maxlen = self.history)
+		self.telegrams[self.rx_address].append(telegram)
+		
+		self.rx_buffer = ""
+		self.rx_address = None
+		return telegram
+	
+	def get_telegrams(self, address):
+		"""
+		Return a list of all recorded telegrams for the given address
+		"""
+		
+		with self.lock:
+			return list(self.telegrams.get(address, ()))
+	
+	def get_stats(self):
+		with self.lock:
+			return {
+				'bytes': self.byte_count,
+				'telegrams': dict((address, len(telegrams)) for address, telegrams in self.telegrams.iteritems()),
+				'checksum_errors': self.checksum_errors,
+				'framing_errors': self.framing_errors,
+				'busy_until': self.busy_until,
+				'now': self.now(),
+			}
\ No newline at end of file
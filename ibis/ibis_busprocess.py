@@ -0,0 +1,272 @@
+# Copyright (C) 2014 Julian Metzler
+# See the LICENSE file for the full license.
+
+"""
+Bus driver running in a separate process
+
+The controller only encodes telegrams and puts them into a ring buffer in
+shared memory. A dedicated process takes them out and writes them to the
+serial port, so the timing on the wire doesn't depend on what the network
+side is doing. It also keeps refreshing the displays if the network side dies.
+
+Only one bus process can drive a serial port: it holds an exclusive lock on a
+lock file which contains its PID. A new bus process for the same port stops the
+old one (e.g. one left behind by a crashed server) and takes over. The lock files
+are kept in a directory only the user running the server can write to, so nobody
+else can make a new server signal another process.
+"""
+
+import multiprocessing
+import os
+import re
+import signal
+import stat
+import struct
+import tempfile
+import time
+
+from .ibis_protocol import IBISMaster
+
+try:
+	import fcntl
+	HAVE_FCNTL = True
+except ImportError:
+	HAVE_FCNTL = False
+
+# Record kinds
+RECORD_TELEGRAM = 1
+RECORD_STOP_INDICATOR = 2
+RECORD_STOP = 3
+
+class TelegramRing(object):
+	"""
+	Single producer, single consumer ring buffer of records in shared memory.
+	
+	<head> (the number of records written) is only changed by the producer and
+	<tail> (the number of records read) only by the consumer. A record is written
+	completely before <head> is advanced, and read completely before <tail> is
+	advanced, so the records themselves need no lock.
+	
+	The counters are read and written under their locks anyway: CPUs like the ARM
+	cores of the Raspberry Pi may reorder memory accesses, and taking and releasing
+	a lock is a memory barrier. Without it, the consumer could see the new <head>
+	before the record it belongs to.
+	"""
+	
+	# Kind, address, length of the data
+	RECORD_HEADER = struct.Struct("<BBH")
+	
+	def __init__(self, slots = 64, slot_size = 256):
+		self.slots = slots
+		self.slot_size = slot_size
+		self.data = multiprocessing.RawArray('c', slots * slot_size)
+		self.head = multiprocessing.Value('L', 0)
+		self.tail = multiprocessing.Value('L', 0)
+	
+	def __len__(self):
+		return self.get_head() - self.get_tail()
+	
+	def get_head(self):
+		with self.head.get_lock():
+			return self.head.value
+	
+	def get_tail(self):
+		with self.tail.get_lock():
+			return self.tail.value
+	
+	def push(self, kind, address, data = ""):
+		"""
+		Append a record. Returns False if the ring is full.
+		"""
+		
+		record = self.RECORD_HEADER.pack(kind, address, len(data)) + data
+		if len(record) > self.slot_size:
+			raise ValueError("Record too long (%i bytes, slots have %i)" % (len(record), self.slot_size))
+		
+		head = self.head.value
+		if head - self.get_tail() >= self.slots:
+			return False
+		
+		offset = (head % self.slots) * self.slot_size
+		self.data[offset:offset + len(record)] = record
+		with self.head.get_lock():
+			self.head.value = head + 1
+		return True
+	
+	def pop(self):
+		"""
+		Remove the oldest record and return it as a (kind, address, data) tuple,
+		or return None if the ring is empty
+		"""
+		
+		tail = self.tail.value
+		if tail == self.get_head():
+			return None
+		
+		offset = (tail % self.slots) * self.slot_size
+		kind, address, length = self.RECORD_HEADER.unpack(self.data[offset:offset + self.RECORD_HEADER.size])
+		start = offset + self.RECORD_HEADER.size
+		data = self.data[start:start + length]
+		with self.tail.get_lock():
+			self.tail.value = tail + 1
+		return kind, address, data
+
+def get_lock_dir():
+	"""
+	Return the directory for the lock files of the current user, creating it if necessary.
+	Raises IOError if it exists but isn't private to the user.
+	"""
+	
+	path = os.path.join(tempfile.gettempdir(), "ibis-%i" % os.getuid())
+	try:
+		os.mkdir(path, 0700)
+	except OSError:
+		pass
+	
+	info = os.lstat(path)
+	if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0077:
+		raise IOError("%s is not a private directory of the current user" % path)
+	return path
+
+def get_lock_filename(port):
+	"""
+	Return the name of the lock file for the bus process of a serial port
+	"""
+	
+	return os.path.join(get_lock_dir(), "bus-%s.lock" % re.sub(r"[^A-Za-z0-9]+", "_", port).strip("_"))
+
+def acquire_port_lock(filename, timeout = 5.0):
+	"""
+	Open and exclusively lock the lock file of a serial port. If another bus process
+	holds the lock, it's asked to stop (with SIGTERM) and the lock is taken over once
+	it has exited. Returns the open lock file, which keeps the lock until it's closed.
+	"""
+	
+	lock_file = open(filename, 'a+')
+	end = time.time() + timeout
+	signalled = False
+	while True:
+		try:
+			fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+			return lock_file
+		except IOError:
+			pass
+		
+		if not signalled:
+			lock_file.seek(0)
+			try:
+				pid = int(lock_file.read().strip())
+				os.kill(pid, signal.SIGTERM)
+			except (ValueError, OSError):
+				pass
+			signalled = True
+		
+		if time.time() >= end:
+			lock_file.close()
+			raise IOError("The serial port is still used by another bus process (see %s)" % filename)
+		time.sleep(0.05)
+
+def run_bus(ring, port, gpio_pinmap, refresh_timeout):
+	"""
+	Main loop of the bus process: send everything from the ring to the serial port
+	and resend the last telegram of every display after <refresh_timeout> seconds
+	"""
+	
+	master = IBISMaster(port, gpio_pinmap = gpio_pinmap)
+	last_telegrams = {}
+	
+	try:
+		while True:
+			record = ring.pop()
+			if record is None:
+				# Refresh the displays, even if nothing comes in anymore
+				now = time.time()
+				for address, (telegram, last_sent) in last_telegrams.items():
+					if last_sent + refresh_timeout <= now:
+						master.select_address(address)
+						master.send_raw(telegram)
+						last_telegrams[address] = (telegram, now)
+				time.sleep(0.005)
+				continue
+			
+			kind, address, data = record
+			if kind == RECORD_TELEGRAM:
+				master.select_address(address)
+				master.send_raw(data)
+				last_telegrams[address] = (data, time.time())
+			elif kind == RECORD_STOP_INDICATOR:
+				master.set_stop_indicator(address, data == "\x01")
+			elif kind == RECORD_STOP:
+				break
+	except KeyboardInterrupt:
+		pass
+
+class BusProcessMaster(IBISMaster):
+	"""
+	IBISMaster that hands its telegrams to a bus process instead of writing them
+	to the serial port itself. The bus process opens <port> and controls the
+	multiplexer and the stop indicators.
+	
+	The bus process is not a daemon: if the network side crashes, the displays keep
+	being refreshed until the process is stopped by close(), a signal or the next
+	server on the port. <lock_filename> is the lock file that makes sure only one
+	bus process drives the port (see get_lock_filename).
+	"""
+	
+	def __init__(self, port, gpio_pinmap = {}, tracer = None, slots = 64, refresh_timeout = 120.0, lock_filename = None):
+		self.port = port
+		self.gpio_pinmap = gpio_pinmap
+		self.tracer = tracer
+		self.device = None
+		self.sleep = time.sleep
+		self.address = 0
+		
+		self.ring = TelegramRing(slots)
+		self.process = multiprocessing.Process(target = run_bus, args = (self.ring, port, gpio_pinmap, refresh_timeout), name = "ibis-bus")
+		if not HAVE_FCNTL:
+			self.process.start()
+			return
+		
+		lock_file = acquire_port_lock(lock_filename or get_lock_filename(port))
+		try:
+			self.process.start()
+			# The bus process has inherited the locked file, so it keeps the lock until it exits
+			lock_file.seek(0)
+			lock_file.truncate()
+			lock_file.write("%i\n" % self.process.pid)
+		finally:
+			lock_file.close()
+	
+	def push(self, kind, address, data = ""):
+		# Nothing would ever take the record out of the ring
+		if not self.process.is_alive():
+			raise IOError("The bus process has stopped")
+		
+		# If the ring is full, wait for the bus to catch up
+		while not self.ring.push(kind, address, data):
+			if not self.process.is_alive():
+				raise IOError("The bus process has stopped")
+			time.sleep(self.BYTE_TIME)
+	
+	def select_address(self, address):
+		self.address = address
+	
+	def set_stop_indicator(self, address, value):
+		self.push(RECORD_STOP_INDICATOR, address, "\x01" if value else "\x00")
+	
+	def send_raw(self, data):
+		if self.tracer:
+			self.tracer.mark_current('send_raw')
+		self.push(RECORD_TELEGRAM, self.address, data)
+		if self.tracer:
+			self.tracer.mark_current('ring')
+		return len(data)
+	
+	def close(self):
+		"""
+		Stop the bus process once it has sent everything in the ring
+		"""
+		
+		if self.process.is_alive():
+			self.push(RECORD_STOP, 0)
+			self.process.join()
\ No newline at end of file
@@ -99,6 +99,22 @@ class Client(object):
 		
 		return self.set_message(address, self.make_time(format, duration), priority, client)
 	
+	def make_ticker(self, text, length = None, interval = None):
+		message = {'type': 'ticker', 'text': text}
+		if length:
+			message['length'] = length
+		if interval:
+			message['interval'] = interval
+		
+		return message
+	
+	def set_ticker(self, address, text, length = None, interval = None, priority = 0, client = None):
+		"""
+		Set a display to show scrolling text
+		"""
+		
+		return self.set_message(address, self.make_ticker(text, length, interval), priority, client)
+	
 	def set_sequence(self, address, sequence, interval, priority = 0, client = None):
 		"""
 		Set a display to display a sequence of messages
@@ -151,4 +167,12 @@ class Client(object):
 		for subsection, subdict in status.iteritems():
 			subdict = dict([(int(key), value) for key, value in subdict.iteritems()])
 			status[subsection] = subdict
-		return status
\ No newline at end of file
+		return status
+	
+	def get_trace_stats(self):
+		"""
+		Query the server for the latency percentiles of each processing stage
+		(only available if the server was started with tracing enabled)
+		"""
+		
+		return self.send_raw_message({'query': 'trace'})
\ No newline at end of file
@@ -0,0 +1,116 @@
+# Copyright (C) 2014 Julian Metzler
+# See the LICENSE file for the full license.
+
+"""
+Streaming decoder for IBIS telegrams
+"""
+
+import collections
+import re
+
+from .ibis_utils import checksum, reverse_prepare_text
+
+Telegram = collections.namedtuple('Telegram', ('type', 'fields', 'data', 'valid'))
+
+TELEGRAM_PATTERNS = (
+	('special_character', re.compile(r"^lE(\d{2})$"), ('character', )),
+	('line_number', re.compile(r"^l(\d{3})$"), ('line_number', )),
+	('target_text__003a', re.compile(r"^zA(\d)(.*)$", re.S), ('blocks', 'text')),
+	('next_stop__003c', re.compile(r"^zI(\d)(.*)$", re.S), ('blocks', 'text')),
+	('target_number', re.compile(r"^z(\d{3})$"), ('target_number', )),
+	('target_text__021t', re.compile(r"^aA([0-9:;<=>?])(\d+)A([0-9:;<=>?])(.*\n.*)$", re.S), ('id', 'blocks', 'cycle', 'text')),
+	('target_text__021', re.compile(r"^aA(\d)(\d)(.*)$", re.S), ('id', 'blocks', 'text')),
+	('next_stop__009', re.compile(r"^v(.*)$", re.S), ('text', )),
+	('time', re.compile(r"^u(\d{2})(\d{2})$"), ('hours', 'minutes')),
+	('date', re.compile(r"^d(\d{2})(\d{2})(\d+)$"), ('day', 'month', 'year')),
+)
+
+def parse_telegram(data, valid = True):
+	"""
+	Turn the contents of a telegram (without the trailing CR and checksum)
+	into a Telegram with a type name and a dict of decoded fields
+	"""
+	
+	for name, pattern, field_names in TELEGRAM_PATTERNS:
+		match = pattern.match(data)
+		if match is None:
+			continue
+		
+		fields = {}
+		for field_name, value in zip(field_names, match.groups()):
+			if field_name == 'text':
+				fields[field_name] = reverse_prepare_text(value.rstrip(" ")).decode('utf-8')
+			elif field_name in ('id', 'cycle'):
+				fields[field_name] = "0123456789:;<=>?".index(value)
+			else:
+				fields[field_name] = int(value)
+		return Telegram(name, fields, data, valid)
+	
+	return Telegram('unknown', {}, data, valid)
+
+class TelegramDecoder(object):
+	"""
+	Incremental decoder that can be fed raw bytes in chunks of any size.
+	Telegrams are terminated by a CR followed by the checksum byte.
+	
+	Memory use is bounded: if no CR shows up within MAX_LENGTH bytes,
+	the buffered data is dropped and counted as an overflow.
+	"""
+	
+	MAX_LENGTH = 256
+	
+	def __init__(self, parse = True):
+		self.parse = parse
+		self.buffer = ""
+		self.telegram_count = 0
+		self.checksum_errors = 0
+		self.overflow_errors = 0
+	
+	def feed(self, data):
+		"""
+		Consume the given bytes and return a list of every telegram completed by them
+		"""
+		
+		telegrams = []
+		buffer = self.buffer + data
+		start = 0
+		while True:
+			end = buffer.find("\r", start)
+			if end == -1 or end + 1 >= len(buffer):
+				break
+			
+			message = buffer[start:end + 1]
+			valid = checksum(message) == buffer[end + 1]
+			start = end + 2
+			
+			self.telegram_count += 1
+			if not valid:
+				self.checksum_errors += 1
+			
+			if self.parse:
+				telegrams.append(parse_telegram(message[:-1], valid))
+			else:
+				telegrams.append(Telegram(None, None, message[:-1], valid))
+		
+		buffer = buffer[start:]
+		if len(buffer) > self.MAX_LENGTH:
+			self.overflow_errors += 1
+			buffer = ""
+		self.buffer = buffer
+		return telegrams
+	
+	def reset(self):
+		self.buffer = ""
+	
+	def decode_stream(self, stream, chunk_size = 64):
+		"""
+		Read from a file-like object (e.g. a capture file or serial port)
+		until it's exhausted and yield all decoded telegrams
+		"""
+		
+		while True:
+			data = stream.read(chunk_size)
+			if not data:
+				break
+			for telegram in self.feed(data):
+				yield telegram
\ No newline at end of file
@@ -5,23 +5,249 @@
 
 """
 Ethernet protocol wrapper
+
+Texts are sent to the EthernetIBIS gateway as frames terminated by a newline,
+so many texts can be sent over a single connection.
 """
 
+import collections
+import Queue
+import select
 import socket
+import threading
+import time
+from .ibis_tracing import percentile
 from .ibis_utils import prepare_text
 
+# The gateway's message buffer is 150 bytes, including the terminating NUL byte
+MAX_FRAME_LENGTH = 149
+
+def make_frame(text):
+    """
+    Build the frame for a text: the prepared text without line breaks, followed by a newline
+    """
+    
+    data = prepare_text(text).replace("\r", " ").replace("\n", " ")
+    return data[:MAX_FRAME_LENGTH] + "\n"
+
 class EthernetWrapper(object):
-    def __init__(self, host, port, timeout = 5.0):
+    def __init__(self, host, port, timeout = 5.0, persistent = True):
+        """
+        If <persistent> is True, the connection is kept open between messages
+        and only re-established if sending fails
+        """
+        
         self.host = host
         self.port = port
         self.timeout = timeout
+        self.persistent = persistent
         self.socket = None
     
-    def send_message(self, text):
+    def connect(self):
+        self.close()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(self.timeout)
             sock.connect((self.host, self.port))
-            sock.sendall(prepare_text(text))
-        finally:
-            sock.close()
\ No newline at end of file
+        except:
+            sock.close()
+            raise
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket = sock
+    
+    def close(self):
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            finally:
+                self.socket = None
+    
+    def is_connected(self):
+        """
+        Check whether the connection is still open and close it if the gateway
+        has closed its end (e.g. because it was restarted). Sending on such a
+        connection would appear to work, but the text would be lost.
+        """
+        
+        if self.socket is None:
+            return False
+        
+        # The gateway never sends anything, so a readable socket means it was closed
+        try:
+            readable = select.select([self.socket], [], [], 0)[0]
+            closed = bool(readable) and self.socket.recv(1) == ""
+        except (select.error, socket.error):
+            closed = True
+        
+        if closed:
+            self.close()
+        return not closed
+    
+    def send_message(self, text):
+        frame = make_frame(text)
+        
+        if not self.persistent:
+            try:
+                self.connect()
+                self.socket.sendall(frame)
+            finally:
+                self.close()
+            return
+        
+        try:
+            if not self.is_connected():
+                self.connect()
+            self.socket.sendall(frame)
+        except socket.error:
+            # The gateway may have dropped the connection, try again once with a new one
+            self.connect()
+            try:
+                self.socket.sendall(frame)
+            except:
+                self.close()
+                raise
+
+class Gateway(object):
+    """
+    One EthernetIBIS gateway in a GatewayGroup, with its connection and statistics
+    """
+    
+    # The gateway closes connections that have been idle for this long (CLIENT_TIMEOUT in the sketch)
+    IDLE_TIMEOUT = 30.0
+    
+    def __init__(self, host, port, timeout = 5.0, history = 1000):
+        self.host = host
+        self.port = port
+        self.wrapper = EthernetWrapper(host, port, timeout = timeout)
+        self.lock = threading.Lock()
+        self.last_text = None
+        self.last_send = 0.0
+        self.sent = 0
+        self.skipped = 0
+        self.failures = 0
+        self.last_error = None
+        self.latencies = collections.deque(maxlen = history)
+    
+    def send_message(self, text, force = False):
+        """
+        Send a text unless it's the one that was sent last.
+        Returns True if the text was sent, None if it was skipped.
+        
+        The text is sent again if sending failed, or if the gateway was restarted
+        (which shows its IP address). A restart is detected by the connection having
+        been closed before the gateway would have closed it for being idle.
+        """
+        
+        with self.lock:
+            if self.wrapper.socket is not None and not self.wrapper.is_connected():
+                if time.time() - self.last_send < self.IDLE_TIMEOUT:
+                    self.last_text = None
+            
+            if text == self.last_text and not force:
+                self.skipped += 1
+                return None
+            
+            start = time.time()
+            try:
+                self.wrapper.send_message(text)
+            except Exception as e:
+                self.failures += 1
+                self.last_error = "%s: %s" % (type(e).__name__, e)
+                self.last_text = None
+                self.wrapper.close()
+                raise
+            
+            self.last_send = time.time()
+            self.latencies.append(self.last_send - start)
+            self.last_text = text
+            self.sent += 1
+            return True
+    
+    def get_stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+        
+        return {
+            'sent': self.sent,
+            'skipped': self.skipped,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'p50_ms': percentile(latencies, 0.50) * 1000.0 if latencies else None,
+            'p95_ms': percentile(latencies, 0.95) * 1000.0 if latencies else None,
+            'max_ms': latencies[-1] * 1000.0 if latencies else None,
+        }
+
+class GatewayGroup(object):
+    """
+    Sends texts to displays on many EthernetIBIS gateways, addressed by name.
+    
+    <displays> maps display names to the (host, port) of their gateway.
+    The texts are sent concurrently by a pool of <workers> threads, each gateway
+    keeping one persistent connection. Texts that a gateway is already showing
+    aren't sent again (the gateway refreshes the display by itself).
+    """
+    
+    def __init__(self, displays, workers = 8, timeout = 5.0):
+        self.displays = {}
+        self.gateways = {}
+        for name, (host, port) in displays.iteritems():
+            if (host, port) not in self.gateways:
+                self.gateways[(host, port)] = Gateway(host, port, timeout = timeout)
+            self.displays[name] = self.gateways[(host, port)]
+        
+        self.queue = Queue.Queue()
+        self.workers = workers
+        for i in range(workers):
+            thread = threading.Thread(target = self.worker)
+            thread.daemon = True
+            thread.start()
+    
+    def worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            
+            name, text, force, results = job
+            try:
+                result = self.displays[name].send_message(text, force)
+            except Exception:
+                result = False
+            results.put((name, result))
+    
+    def send(self, texts, force = False):
+        """
+        Send texts to many displays at once. <texts> maps display names to texts.
+        Returns a dict mapping the display names to True (sent), None (skipped
+        because the text didn't change) or False (failed).
+        """
+        
+        results = Queue.Queue()
+        for name, text in texts.iteritems():
+            if name not in self.displays:
+                raise KeyError("Unknown display: %s" % name)
+            self.queue.put((name, text, force, results))
+        
+        return dict(results.get() for i in range(len(texts)))
+    
+    def send_message(self, name, text, force = False):
+        return self.send({name: text}, force)[name]
+    
+    def close(self):
+        """
+        Stop the worker threads and close all connections
+        """
+        
+        for i in range(self.workers):
+            self.queue.put(None)
+        
+        for gateway in self.gateways.values():
+            with gateway.lock:
+                gateway.wrapper.close()
+    
+    def get_stats(self):
+        """
+        Return the statistics of every gateway, keyed by "host:port"
+        """
+        
+        return dict(("%s:%i" % address, gateway.get_stats()) for address, gateway in self.gateways.iteritems())
\ No newline at end of file
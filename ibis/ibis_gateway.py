@@ -0,0 +1,249 @@
+# Copyright (C) 2015 Julian Metzler
+# See the LICENSE file for the full license.
+
+"""
+Emulator of the EthernetIBIS gateway (arduino/EthernetIBIS) for testing without the hardware
+"""
+
+import select
+import serial
+import socket
+import threading
+import time
+
+from .ibis_utils import checksum
+
+def open_output(output):
+	"""
+	Open the serial port (e.g. ibisbus://gateway) the gateway writes to,
+	or return <output> as it is if it's already a file-like object
+	"""
+	
+	if not isinstance(output, basestring):
+		return output
+	
+	return serial.serial_for_url(
+		output,
+		baudrate = 1200,
+		bytesize = serial.SEVENBITS,
+		parity = serial.PARITY_EVEN,
+		stopbits = serial.STOPBITS_TWO
+	)
+
+def encode_003c(text):
+	"""
+	Build a 003c telegram exactly like sendIBIS003c in the sketch does
+	"""
+	
+	blocks, remainder = divmod(len(text), 4)
+	if remainder:
+		blocks += 1
+	
+	datagram = "zI%i%s\r" % (blocks, text.ljust(blocks * 4))
+	return datagram + checksum(datagram)
+
+class EthernetGateway(object):
+	"""
+	Accepts connections just like the sketch and sends every received text
+	to the display as a 003c telegram, written to <output> (a serial port URL
+	or a file-like object such as a capture file).
+	
+	Texts are frames terminated by a newline. Leftover data is processed when
+	the client disconnects. Like the sketch, only one client is served at a time,
+	but between frames the gateway switches to any other connection that has sent
+	data and closes the idle one. Clients that send nothing for CLIENT_TIMEOUT
+	seconds are disconnected. Like on the real gateway, texts that aren't changed
+	are sent again every REFRESH_TIMEOUT seconds.
+	
+	Options:
+		
+		latency          Additional time in seconds it takes to process a message
+		serial_timing    Wait for every telegram to be transmitted at 1200 baud,
+		                 like Serial.print does once its buffer is full
+		framed           If False, behave like the old sketch which treats everything
+		                 a client sends until it disconnects as one message
+		                 (and doesn't switch to another client before that)
+	
+	Messages that don't fit into the MESSAGE_SIZE byte buffer are truncated and
+	counted as overflows. (The old sketch would write past the end of its buffer.)
+	"""
+	
+	MESSAGE_SIZE = 150
+	REFRESH_TIMEOUT = 120.0
+	CLIENT_TIMEOUT = 30.0
+	
+	# Time it takes to transmit one byte at 1200 baud 7E2
+	BYTE_TIME = 12 / 1200.0
+	
+	def __init__(self, output, host = "127.0.0.1", port = 1337, latency = 0.0, serial_timing = False, framed = True):
+		self.device = open_output(output)
+		self.host = host
+		self.port = port
+		self.latency = latency
+		self.serial_timing = serial_timing
+		self.framed = framed
+		self.running = False
+		self.socket = None
+		self.lock = threading.Lock()
+		
+		# Virtual devices (like ibisbus://) can provide their own notion of time
+		self.sleep = getattr(self.device, 'sleep', time.sleep)
+		
+		self.current_text = ""
+		self.last_refresh = time.time()
+		self.message_count = 0
+		self.connection_count = 0
+		self.overflow_count = 0
+		self.refresh_count = 0
+		self.byte_count = 0
+	
+	def send_003c(self, text):
+		telegram = encode_003c(text)
+		with self.lock:
+			self.device.write(telegram)
+			if hasattr(self.device, 'flush'):
+				self.device.flush()
+			self.byte_count += len(telegram)
+			self.current_text = text
+			self.last_refresh = time.time()
+		
+		if self.serial_timing:
+			self.sleep(len(telegram) * self.BYTE_TIME)
+	
+	def prevent_timeout(self):
+		if time.time() - self.last_refresh >= self.REFRESH_TIMEOUT:
+			self.refresh_count += 1
+			self.send_003c(self.current_text)
+	
+	def start(self):
+		"""
+		Start listening in a background thread. If <port> is 0, a free port is
+		chosen and stored in the port attribute.
+		"""
+		
+		self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.socket.bind((self.host, self.port))
+		self.socket.listen(5)
+		self.socket.settimeout(0.5)
+		self.port = self.socket.getsockname()[1]
+		self.running = True
+		
+		# The sketch shows its address on the display once it's up
+		self.send_003c("Obtaining IP...")
+		self.send_003c("%s:%i" % (self.host, self.port))
+		
+		thread = threading.Thread(target = self.run)
+		thread.daemon = True
+		thread.start()
+		return thread
+	
+	def stop(self):
+		self.running = False
+	
+	def run(self):
+		client = None
+		pending = {}
+		self.reset_message()
+		try:
+			while self.running:
+				# Pending connections can only be served between frames. While the client is in
+				# the middle of one, they'd make select return right away without anything to do.
+				between_frames = not self.length and not self.overflow and (self.framed or client is None)
+				sockets = [self.socket] + (pending.keys() if between_frames else []) + ([client] if client else [])
+				readable = select.select(sockets, [], [], 0.1)[0]
+				now = time.time()
+				
+				if self.socket in readable:
+					conn, addr = self.socket.accept()
+					self.connection_count += 1
+					pending[conn] = now
+				
+				if client in readable:
+					try:
+						data = client.recv(1024)
+					except socket.error:
+						data = ""
+					if data:
+						self.receive(data)
+						last_activity = now
+					else:
+						client = self.close_client(client)
+				elif client and now - last_activity >= self.CLIENT_TIMEOUT:
+					client = self.close_client(client)
+				
+				# Between frames, serve any connection that has sent data
+				between_frames = not self.length and not self.overflow and (self.framed or client is None)
+				for conn in [conn for conn in readable if conn in pending]:
+					if not between_frames:
+						break
+					del pending[conn]
+					if client:
+						client.close()
+					client = conn
+					last_activity = now
+					between_frames = False
+				
+				# Connections that never send anything are dropped as well
+				for conn, accepted in pending.items():
+					if now - accepted >= self.CLIENT_TIMEOUT:
+						del pending[conn]
+						conn.close()
+				
+				self.prevent_timeout()
+		finally:
+			if client:
+				client.close()
+			for conn in pending:
+				conn.close()
+			self.socket.close()
+	
+	def reset_message(self):
+		self.message = []
+		self.length = 0
+		self.overflow = False
+	
+	def receive(self, data):
+		frames = data.split("\n") if self.framed else [data]
+		for index, frame in enumerate(frames):
+			if index > 0:
+				# The previous frame is complete
+				self.process_message("".join(self.message), self.overflow)
+				self.reset_message()
+			
+			if self.framed:
+				frame = frame.replace("\r", "")
+			space = self.MESSAGE_SIZE - 1 - self.length
+			if len(frame) > space:
+				self.overflow = True
+				frame = frame[:space]
+			self.message.append(frame)
+			self.length += len(frame)
+	
+	def close_client(self, client):
+		# Process whatever the client sent before disconnecting
+		if self.length or self.overflow or not self.framed:
+			self.process_message("".join(self.message), self.overflow)
+		self.reset_message()
+		client.close()
+		return None
+	
+	def process_message(self, message, overflow = False):
+		if overflow:
+			self.overflow_count += 1
+		
+		if self.latency:
+			time.sleep(self.latency)
+		
+		self.send_003c(message)
+		self.message_count += 1
+	
+	def get_stats(self):
+		return {
+			'messages': self.message_count,
+			'connections': self.connection_count,
+			'overflows': self.overflow_count,
+			'refreshes': self.refresh_count,
+			'bytes': self.byte_count,
+			'current_text': self.current_text,
+		}
\ No newline at end of file
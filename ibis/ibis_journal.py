@@ -0,0 +1,162 @@
+# Copyright (C) 2014 Julian Metzler
+# See the LICENSE file for the full license.
+
+"""
+Append-only journal for the state of the server
+
+Instead of rewriting the whole configuration file on every change, each change
+is appended to a journal file as one line of JSON. Every now and then, the
+journal is compacted: the complete state is written to the snapshot file (which
+has the same format as the ibis.json written by Controller.save_config) and the
+journal is cleared. On startup, the snapshot is loaded and the journal replayed.
+"""
+
+import json
+import os
+import threading
+import time
+
+class StateJournal(object):
+	"""
+	Journal of changes (dicts with an 'op' key, see apply) on top of a snapshot.
+	
+	Every change gets a sequence number. The snapshot stores the number of the last
+	change it contains, so changes that are still in the journal because a crash
+	happened during compaction aren't applied twice. A change that was only partly
+	written when the process died is dropped when loading.
+	
+	The journal is compacted once it's larger than <max_size> bytes, or on the first
+	change after <max_age> seconds. If <fsync> is True, every change is forced to
+	disk before append returns.
+	"""
+	
+	def __init__(self, filename = "ibis.json", max_size = 1024 * 1024, max_age = 3600.0, fsync = False):
+		self.filename = filename
+		self.journal_filename = filename + ".journal"
+		self.max_size = max_size
+		self.max_age = max_age
+		self.fsync = fsync
+		self.lock = threading.Lock()
+		self.file = None
+		self.sequence = 0
+		self.size = 0
+		self.last_compaction = time.time()
+	
+	def empty_state(self):
+		return {
+			'buffer': {},
+			'current_text': {},
+			'enabled': {},
+			'stop_indicators': {},
+		}
+	
+	def apply(self, state, change):
+		"""
+		Apply a change to a state in the format of the snapshot
+		"""
+		
+		address = str(change['address'])
+		if change['op'] == 'message':
+			state['buffer'][address] = {
+				'message': change['message'],
+				'priority': change['priority'],
+				'client': change['client'],
+			}
+		elif change['op'] == 'enabled':
+			state['enabled'][address] = change['value']
+		elif change['op'] == 'stop_indicator':
+			state['stop_indicators'][address] = change['value']
+		else:
+			raise ValueError("Unknown change: %s" % change['op'])
+	
+	def load(self):
+		"""
+		Load the snapshot, replay the journal on top of it and return the resulting state.
+		The journal is opened for appending afterwards.
+		"""
+		
+		with self.lock:
+			try:
+				with open(self.filename, 'r') as f:
+					state = json.loads(f.read())
+			except IOError:
+				state = self.empty_state()
+			
+			snapshot_sequence = state.pop('journal_sequence', 0)
+			self.sequence = snapshot_sequence
+			valid_size = 0
+			try:
+				with open(self.journal_filename, 'r') as f:
+					for line in f:
+						# Stop at a line that was cut off by a crash
+						if not line.endswith("\n"):
+							break
+						try:
+							change = json.loads(line)
+						except ValueError:
+							break
+						
+						valid_size += len(line)
+						if change['sequence'] > snapshot_sequence:
+							self.apply(state, change)
+							self.sequence = change['sequence']
+			except IOError:
+				pass
+			
+			self.file = open(self.journal_filename, 'a')
+			# Cut off a broken line, so new changes are not appended to it
+			self.file.truncate(valid_size)
+			self.size = valid_size
+			self.last_compaction = time.time()
+			return state
+	
+	def needs_compaction(self):
+		return self.size >= self.max_size or (self.size > 0 and time.time() - self.last_compaction >= self.max_age)
+	
+	def append(self, change):
+		"""
+		Write a change to the journal.
+		Returns True if the journal should be compacted now.
+		"""
+		
+		with self.lock:
+			if self.file is None:
+				self.file = open(self.journal_filename, 'a')
+			
+			self.sequence += 1
+			line = json.dumps(dict(change, sequence = self.sequence)) + "\n"
+			self.file.write(line)
+			self.file.flush()
+			if self.fsync:
+				os.fsync(self.file.fileno())
+			self.size += len(line)
+			return self.needs_compaction()
+	
+	def compact(self, get_state):
+		"""
+		Write a new snapshot and clear the journal.
+		<get_state> is called to get the current state while no changes can be appended.
+		"""
+		
+		with self.lock:
+			state = dict(get_state(), journal_sequence = self.sequence)
+			
+			# Replace the snapshot atomically, so there always is a complete one
+			temp_filename = self.filename + ".tmp"
+			with open(temp_filename, 'w') as f:
+				f.write(json.dumps(state))
+				f.flush()
+				os.fsync(f.fileno())
+			os.rename(temp_filename, self.filename)
+			
+			if self.file is not None:
+				self.file.close()
+			self.file = open(self.journal_filename, 'w')
+			self.size = 0
+			self.last_compaction = time.time()
+	
+	def close(self):
+		with self.lock:
+			if self.file is not None:
+				self.file.close()
+				self.file = None
\ No newline at end of file
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Julian Metzler
+# See the LICENSE file for the full license.
+
+"""
+Text layout based on the pixel widths of the simulator fonts
+"""
+
+import collections
+import os
+import re
+
+"""
+Abbreviations that are tried in order (cumulatively) on texts that don't fit.
+These are the common ones in German station names.
+"""
+DEFAULT_ABBREVIATIONS = (
+	(re.compile(ur"Hauptbahnhof", re.U), u"Hbf"),
+	(re.compile(ur"Personenbahnhof", re.U), u"Pbf"),
+	(re.compile(ur"Güterbahnhof", re.U), u"Gbf"),
+	(re.compile(ur"Rangierbahnhof", re.U), u"Rbf"),
+	(re.compile(ur"Bahnhof", re.U), u"Bf"),
+	(re.compile(ur"(?<=\w)straße\b", re.U), u"str."),
+	(re.compile(ur"\bStraße\b", re.U), u"Str."),
+	(re.compile(ur"\bPlatz\b", re.U), u"Pl."),
+	(re.compile(ur"\bSankt\b", re.U), u"St."),
+	(re.compile(ur"([\s\(])bei\b", re.U), ur"\1b"),
+	(re.compile(ur"([\s\(])Kreis\b", re.U), ur"\1Kr"),
+	(re.compile(ur"\(Main\)", re.U), u"(M)"),
+	(re.compile(ur"\s*\(([^)]*)\)$", re.U), ur" \1"),
+)
+
+FitResult = collections.namedtuple('FitResult', ('text', 'font', 'width', 'overflow', 'abbreviation', 'pages'))
+
+def get_font_name(font):
+	"""
+	Return a short name for a DisplayFont, made of its font folder name and spacing
+	(e.g. "bold/2")
+	"""
+	
+	folder = os.path.basename(os.path.dirname(os.path.abspath(font.fontmap_file)))
+	return "%s/%i" % (folder, font.spacing)
+
+class TextFitter(object):
+	"""
+	Decides how texts are best shown on a display, using the fonts of a DisplaySimulator.
+	
+	For every text, the widest font it fits in is chosen. For texts that don't fit
+	in any font, an abbreviated version and a split into pages are suggested.
+	"""
+	
+	def __init__(self, simulator, abbreviations = DEFAULT_ABBREVIATIONS, max_pages = 4):
+		self.simulator = simulator
+		self.abbreviations = abbreviations
+		self.max_pages = max_pages
+	
+	def get_abbreviations(self, text):
+		"""
+		Return all distinct versions of the text with more and more abbreviations applied
+		"""
+		
+		candidates = []
+		for pattern, replacement in self.abbreviations:
+			abbreviated = pattern.sub(replacement, text)
+			if abbreviated != text:
+				candidates.append(abbreviated)
+				text = abbreviated
+		return candidates
+	
+	def split_pages(self, text, max_length = None):
+		"""
+		Split a text into pages that each fit on the display, breaking at spaces
+		and after hyphens. Returns None if that isn't possible within max_pages pages.
+		If <max_length> is given, no page is longer than that many characters.
+		"""
+		
+		narrowest = self.simulator.fonts[-1]
+		width = self.simulator.width
+		pages = []
+		rest = text.strip()
+		while rest:
+			if len(pages) == self.max_pages:
+				return None
+			
+			length = narrowest.get_fitting_length(rest, width)
+			if max_length is not None:
+				length = min(length, max_length)
+			if length >= len(rest):
+				pages.append(rest)
+				break
+			
+			# Break at the last space or hyphen that still fits
+			breaks = [index for index in range(1, length + 1) if rest[index] == " " or rest[index - 1] == "-"]
+			if not breaks:
+				return None
+			
+			pages.append(rest[:breaks[-1]].strip())
+			rest = rest[breaks[-1]:].strip()
+		
+		return pages
+	
+	def fit(self, texts):
+		"""
+		Lay out many texts at once and return a list of FitResults.
+		<abbreviation> and <pages> are None for texts that fit as they are.
+		"""
+		
+		fits = self.simulator.fit_texts(texts)
+		
+		# Try all abbreviations of all overflowing texts in one batch
+		candidates = []
+		owners = []
+		for index, (font, width, overflow) in enumerate(fits):
+			if overflow:
+				abbreviations = self.get_abbreviations(texts[index])
+				candidates.extend(abbreviations)
+				owners.extend([index] * len(abbreviations))
+		
+		abbreviated = {}
+		for owner, candidate, (font, width, overflow) in zip(owners, candidates, self.simulator.fit_texts(candidates)):
+			if not overflow and owner not in abbreviated:
+				abbreviated[owner] = candidate
+		
+		results = []
+		for index, (font, width, overflow) in enumerate(fits):
+			abbreviation = pages = None
+			if overflow:
+				abbreviation = abbreviated.get(index)
+				pages = self.split_pages(texts[index])
+			results.append(FitResult(texts[index], font, width, overflow, abbreviation, pages))
+		
+		return results
+	
+	def fit_text(self, text):
+		return self.fit([text])[0]
+
+class DisplayProfile(object):
+	"""
+	Describes one display for the server's layout stage: its fonts and size
+	(through a TextFitter) and the telegram used to send text to it.
+	
+	Texts that don't fit are abbreviated if that's enough, or split into pages
+	that are shown for <page_duration> seconds each. Layouts are cached per text.
+	"""
+	
+	# Telegrams that can be used and the number of characters they can carry
+	TELEGRAMS = {
+		'next_stop__003c': 36,
+		'next_stop__009': 16,
+		'target_text__003a': 144,
+	}
+	
+	CACHE_SIZE = 1000
+	
+	def __init__(self, fitter, telegram = 'next_stop__003c', page_duration = 3.0):
+		if telegram not in self.TELEGRAMS:
+			raise ValueError("Unsupported telegram: %s" % telegram)
+		
+		self.fitter = fitter
+		self.telegram = telegram
+		self.max_length = self.TELEGRAMS[telegram]
+		self.page_duration = page_duration
+		self.cache = {}
+	
+	def layout_text(self, text):
+		"""
+		Return the list of pages the given text should be shown as
+		"""
+		
+		pages = self.cache.get(text)
+		if pages is not None:
+			return pages
+		
+		result = self.fitter.fit_text(text)
+		if not result.overflow and len(text) <= self.max_length:
+			pages = [text]
+		elif result.abbreviation is not None and len(result.abbreviation) <= self.max_length:
+			pages = [result.abbreviation]
+		else:
+			pages = self.fitter.split_pages(text, self.max_length) or [text[:self.max_length]]
+		
+		if len(self.cache) >= self.CACHE_SIZE:
+			self.cache.clear()
+		self.cache[text] = pages
+		return pages
+	
+	def layout_message(self, message):
+		"""
+		Turn a message (see Controller.set_message) into one where every text is
+		replaced by its pages. Time messages are left alone since their text changes.
+		"""
+		
+		if message is None:
+			return None
+		
+		if message['type'] == 'text':
+			pages = self.layout_text(message['text'])
+			if len(pages) == 1:
+				return dict(message, text = pages[0])
+			return {
+				'type': 'sequence',
+				'messages': [{'type': 'text', 'text': page} for page in pages],
+				'interval': self.page_duration,
+			}
+		elif message['type'] == 'sequence':
+			messages = []
+			for msg in message['messages']:
+				if msg['type'] != 'text':
+					messages.append(msg)
+					continue
+				pages = self.layout_text(msg['text'])
+				duration = msg.get('duration', None)
+				if len(pages) > 1 and duration is None:
+					duration = self.page_duration
+				messages.extend(dict(msg, text = page, duration = duration) for page in pages)
+			return dict(message, messages = messages)
+		
+		return message
\ No newline at end of file
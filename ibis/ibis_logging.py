@@ -0,0 +1,123 @@
+# Copyright (C) 2014 Julian Metzler
+# See the LICENSE file for the full license.
+
+"""
+Logging for the client-server system
+
+The server logs through the standard logging module under the "ibis" logger.
+setup_logging installs a handler that only puts the log records into a queue;
+a background thread formats and writes them, so a slow terminal or pipe never
+holds up a request. Messages are formatted lazily, in the background thread,
+and only if their level is enabled.
+"""
+
+import json
+import logging
+import Queue
+import sys
+import threading
+
+# Attributes every LogRecord has, everything else was passed in <extra>
+RECORD_ATTRIBUTES = frozenset(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | frozenset(('message', 'asctime'))
+
+# Libraries shouldn't print anything unless the application sets up logging
+logging.getLogger("ibis").addHandler(logging.NullHandler())
+
+class JSONFormatter(logging.Formatter):
+	"""
+	Format log records as JSON objects, one per line, including the fields
+	that were passed to the logging call in <extra>
+	"""
+	
+	def format(self, record):
+		data = {
+			'time': record.created,
+			'level': record.levelname,
+			'logger': record.name,
+			'message': record.getMessage(),
+		}
+		
+		for key, value in record.__dict__.iteritems():
+			if key not in RECORD_ATTRIBUTES:
+				data[key] = value
+		
+		if record.exc_info:
+			data['exception'] = self.formatException(record.exc_info)
+		
+		return json.dumps(data, default = repr)
+
+class QueueHandler(logging.Handler):
+	"""
+	Hand log records over to a background thread which passes them on to <handler>.
+	
+	Emitting a record only puts it into a queue. If the queue already holds
+	<capacity> records, new ones are dropped and counted instead of blocking.
+	The arguments of a record are formatted in the background thread, so they
+	must not be changed after logging them.
+	"""
+	
+	def __init__(self, handler, capacity = 10000):
+		logging.Handler.__init__(self)
+		self.handler = handler
+		self.queue = Queue.Queue(capacity)
+		self.dropped = 0
+		self.thread = threading.Thread(target = self.run, name = "ibis-logging")
+		self.thread.daemon = True
+		self.thread.start()
+	
+	def emit(self, record):
+		try:
+			self.queue.put_nowait(record)
+		except Queue.Full:
+			self.dropped += 1
+	
+	def run(self):
+		while True:
+			record = self.queue.get()
+			try:
+				if record is None:
+					break
+				self.handler.handle(record)
+			except Exception:
+				self.handler.handleError(record)
+			finally:
+				self.queue.task_done()
+	
+	def flush(self):
+		"""
+		Wait until all queued records have been written
+		"""
+		
+		if self.thread.is_alive():
+			self.queue.join()
+		self.handler.flush()
+	
+	def close(self):
+		if self.thread.is_alive():
+			self.queue.put(None)
+			self.thread.join()
+		self.handler.close()
+		logging.Handler.close(self)
+
+def setup_logging(level = logging.WARNING, json_lines = False, stream = None, capacity = 10000):
+	"""
+	Send the log messages of the library with at least the given level to <stream>
+	(stderr by default) through a QueueHandler, which is returned.
+	If <json_lines> is True, every message is written as a JSON object on its own line.
+	"""
+	
+	handler = logging.StreamHandler(stream or sys.stderr)
+	if json_lines:
+		handler.setFormatter(JSONFormatter())
+	else:
+		handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+	
+	queue_handler = QueueHandler(handler, capacity = capacity)
+	logger = logging.getLogger("ibis")
+	for old_handler in logger.handlers[:]:
+		logger.removeHandler(old_handler)
+		old_handler.close()
+	logger.addHandler(queue_handler)
+	logger.setLevel(level)
+	logger.propagate = False
+	return queue_handler
\ No newline at end of file
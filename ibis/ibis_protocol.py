@@ -8,7 +8,7 @@ Main protocol library
 
 import serial
 import time
-from ibis_utils import prepare_text
+from ibis_utils import checksum, prepare_text
 
 # Try importing the GPIO lib in case we're on a Raspberry Pi (to control the stop indicators)
 try:
@@ -31,9 +31,13 @@ Example GPIO pinmap:
 """
 
 class IBISMaster(object):
-	def __init__(self, port, gpio_pinmap = {}):
+	# Time it takes to transmit one byte at 1200 baud 7E2
+	BYTE_TIME = 12 / 1200.0
+	
+	def __init__(self, port, gpio_pinmap = {}, tracer = None):
 		self.port = port
 		self.gpio_pinmap = gpio_pinmap
+		self.tracer = tracer
 		
 		if HAVE_GPIO:
 			self.gpio = wiringpi.GPIO(wiringpi.GPIO.WPI_MODE_GPIO)
@@ -48,15 +52,15 @@ class IBISMaster(object):
 			parity = serial.PARITY_EVEN,
 			stopbits = serial.STOPBITS_TWO
 		)
+		
+		# Virtual devices (like ibisbus://) can provide their own notion of time
+		self.sleep = getattr(self.device, 'sleep', time.sleep)
+	
+	def close(self):
+		self.device.close()
 	
 	def hash(self, message):
-		check_byte = 0x7F
-		
-		for char in message:
-			byte = ord(char)
-			check_byte = check_byte ^ byte
-		
-		message += chr(check_byte)
+		message += checksum(message)
 		return message
 	
 	def set_stop_indicator(self, address, value):
@@ -69,19 +73,37 @@ class IBISMaster(object):
 		
 		self.gpio.digitalWrite(pin, bool(value))
 	
+	def select_address(self, address):
+		"""
+		Set the multiplexer to the given display address (0 - 3) using the DTR and RTS lines
+		"""
+		
+		self.device.setDTR(address >> 1 & 1)
+		self.device.setRTS(address & 1)
+	
 	def send_raw(self, data):
 		#print repr(data)
 		hex_data = ""
 		for byte in data:
 			hex_data += "<%s>" % hex(ord(byte))[2:].upper().rjust(2, "0")
 		#print hex_data
+		if self.tracer:
+			self.tracer.mark_current('send_raw')
 		length = self.device.write(data)
-		time.sleep(length * (12 / 1200.0))
+		self.sleep(length * self.BYTE_TIME)
+		if self.tracer:
+			self.tracer.mark_current('wire')
 		return length
 	
+	def encode_message(self, message):
+		"""
+		Return the raw telegram for a message, ready for send_raw
+		"""
+		
+		return self.hash(message + "\r")
+	
 	def send_message(self, message):
-		message = self.hash(message + "\r")
-		return self.send_raw(message)
+		return self.send_raw(self.encode_message(message))
 	
 	def send_line_number(self, line_number):
 		message = "l%03i" % line_number
@@ -103,7 +125,7 @@ class IBISMaster(object):
 		message = "d%02i%02i%i" % (day, month, year)
 		return self.send_message(message)
 	
-	def send_target_text__003a(self, text):
+	def encode_target_text__003a(self, text):
 		text = prepare_text(text)
 		blocks, remainder = divmod(len(text), 16)
 		
@@ -112,7 +134,10 @@ class IBISMaster(object):
 			text += " " * (16 - remainder)
 		
 		message = "zA%i%s" % (blocks, text.upper())
-		return self.send_message(message)
+		return self.encode_message(message)
+	
+	def send_target_text__003a(self, text):
+		return self.send_raw(self.encode_target_text__003a(text))
 	
 	def send_target_text__021(self, text, id):
 		text = prepare_text(text)
@@ -125,12 +150,15 @@ class IBISMaster(object):
 		message = "aA%i%i%s" % (id, blocks, text.upper())
 		return self.send_message(message)
 	
-	def send_next_stop__009(self, next_stop, length = 16):
+	def encode_next_stop__009(self, next_stop, length = 16):
 		next_stop = prepare_text(next_stop)
 		message = "v%s" % next_stop.upper().ljust(length)
-		return self.send_message(message)
+		return self.encode_message(message)
 	
-	def send_next_stop__003c(self, next_stop):
+	def send_next_stop__009(self, next_stop, length = 16):
+		return self.send_raw(self.encode_next_stop__009(next_stop, length))
+	
+	def encode_next_stop__003c(self, next_stop):
 		next_stop = prepare_text(next_stop)
 		blocks, remainder = divmod(len(next_stop), 4)
 		
@@ -139,7 +167,10 @@ class IBISMaster(object):
 			next_stop += " " * (4 - remainder)
 		
 		message = "zI%i%s" % (blocks, next_stop)
-		return self.send_message(message)
+		return self.encode_message(message)
+	
+	def send_next_stop__003c(self, next_stop):
+		return self.send_raw(self.encode_next_stop__003c(next_stop))
 	
 	def send_target_text__021t(self, texts, id, cycle):
 		id = "0123456789:;<=>?"[id]
@@ -8,18 +8,28 @@ Server for the client-server system
 """
 
 import argparse
+import collections
 import ibis
 import json
+import logging
 import socket
-import thread
+import threading
 import time
 
-from .ibis_utils import _receive_datagram, _send_datagram
+from .ibis_busprocess import BusProcessMaster
+from .ibis_journal import StateJournal
+from .ibis_logging import setup_logging
+from .ibis_status import StatusWriter
+from .ibis_tracing import Tracer
+from .ibis_utils import _receive_datagram, _send_datagram, reverse_prepare_text
+
+logger = logging.getLogger(__name__)
 
 class Listener(object):
-	def __init__(self, controller, port = 4245):
+	def __init__(self, controller, port = 4245, tracer = None):
 		self.controller = controller
 		self.port = port
+		self.tracer = tracer
 		self.running = False
 		self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 	
@@ -28,7 +38,7 @@ class Listener(object):
 		
 		# Open the network socket and listen
 		self.socket.bind(('', self.port))
-		print "Listening on port %i" % self.port
+		logger.info("Listening on port %i", self.port)
 		self.socket.listen(1)
 		
 		try:
@@ -36,15 +46,21 @@ class Listener(object):
 				try:
 					# Wait for someone to connect
 					conn, addr = self.socket.accept()
-					print "Accepted connection from %s on port %i" % addr
+					trace_id = self.tracer.start('accept') if self.tracer else None
+					logger.info("Accepted connection from %s on port %i", *addr)
 					
 					# Load the datagram
 					message = _receive_datagram(conn)
 					
 					if message is None:
 						# We received an invalid datagram, just discard it
+						if self.tracer:
+							self.tracer.discard(trace_id)
 						continue
 					
+					if self.tracer:
+						self.tracer.mark(trace_id, 'receive')
+					
 					success = True
 					if 'enable' in message:
 						try:
@@ -57,6 +73,8 @@ class Listener(object):
 						except:
 							success = False
 						_send_datagram(conn, {'success': success})
+						if self.tracer:
+							self.tracer.finish(trace_id, 'reply')
 					elif 'query' in message:
 						if message['query'] == 'current_text':
 							_send_datagram(conn, self.controller.current_text)
@@ -74,6 +92,10 @@ class Listener(object):
 								'stop_indicators': self.controller.stop_indicators
 							}
 							_send_datagram(conn, status)
+						elif message['query'] == 'trace':
+							_send_datagram(conn, self.tracer.get_histograms() if self.tracer else {})
+						if self.tracer:
+							self.tracer.finish(trace_id, 'reply')
 					elif 'stop_indicator' in message:
 						try:
 							if message['stop_indicator'] == 'toggle':
@@ -85,11 +107,15 @@ class Listener(object):
 						except:
 							success = False
 						_send_datagram(conn, {'success': success})
+						if self.tracer:
+							self.tracer.finish(trace_id, 'reply')
 					else:
 						try:
-							success = self.controller.set_message(message['address'], message['message'], priority = message.get('priority', 0), client = message.get('client', addr[0]))
+							success = self.controller.set_message(message['address'], message['message'], priority = message.get('priority', 0), client = message.get('client', addr[0]), trace_id = trace_id)
 						except:
 							success = False
+							if self.tracer:
+								self.tracer.discard(trace_id)
 						_send_datagram(conn, {'success': success})
 				except KeyboardInterrupt:
 					self.quit()
@@ -99,49 +125,76 @@ class Listener(object):
 	def quit(self):
 		self.running = False
 
+"""
+What is set for a display: the message as it came in, the message after the layout stage
+(which is what actually gets sent), the pre-encoded ticker steps and who set it with which priority
+"""
+DisplayEntry = collections.namedtuple('DisplayEntry', ('message', 'layout', 'ticker', 'priority', 'client'))
+EMPTY_ENTRY = DisplayEntry(None, None, None, -1, None)
+
 class Controller(object):
-	DEBUG = False
-	VERBOSE = True
+	"""
+	Keeps track of what every display should show and sends it to the bus.
+	
+	The Controller is used by several threads at once (the Listener, the tick loop
+	and anyone calling set_message directly), so its state is organized like this:
+		
+		entries      The DisplayEntry of every display. Entries are immutable and are
+		             only ever replaced as a whole, so the tick loop always sees a
+		             message together with its own layout and ticker.
+		             Replacing an entry (and the priority check before) happens under
+		             the lock of that display in <locks>, everything else set_message
+		             does (filtering, layout, encoding tickers) happens outside of it.
+		             Power and stop indicator changes take the same lock, and changes
+		             are appended to the journal before it is released.
+		playback     Where the tick loop is in the entry of every display (current step,
+		             last refresh and update). Only the tick loop writes it, by replacing
+		             the dict of a display, and it starts over when the entry changes.
+		bus_lock     Held while selecting the address on the multiplexer and sending
+		             a telegram, so telegrams can't end up on the wrong display.
+		save_lock    Serializes writing the configuration file.
+	
+	Changes are saved by rewriting ibis.json, or by appending them to a StateJournal.
+	If a StatusWriter is given, the status of the displays is published to it after
+	every change and every telegram.
+	"""
+	
 	TIMEOUT = 120.0
 	
-	def __init__(self, master):
+	# Default number of characters visible at once in a ticker
+	TICKER_LENGTH = 20
+	
+	# Fraction of the bus time that all running tickers together may use
+	TICKER_BUS_SHARE = 0.5
+	
+	def __init__(self, master, tracer = None, profiles = None, journal = None, status = None):
+		"""
+		<profiles> is an optional dict mapping display addresses to layout.DisplayProfiles.
+		Messages for these displays are laid out according to the profile once when they
+		are set. Displays without a profile get the text truncated to 36 characters.
+		If <journal> (a StateJournal) is given, the state is loaded from it and every
+		change is appended to it instead of rewriting the configuration file.
+		<status> is an optional StatusWriter (see ibis_status).
+		"""
+		
 		self.master = master
+		self.tracer = tracer
+		self.profiles = profiles or {}
+		self.journal = journal
+		self.status = status
 		self.running = False
 		
-		self.buffer = {
-			0: {
-				'message': None,
-				'priority': -1,
-				'client': None,
-				'current': -1,
-				'last_refresh': 0.0,
-				'last_update': 0.0
-			},
-			1: {
-				'message': None,
-				'priority': -1,
-				'client': None,
-				'current': -1,
-				'last_refresh': 0.0,
-				'last_update': 0.0
-			},
-			2: {
-				'message': None,
-				'priority': -1,
-				'client': None,
-				'current': -1,
-				'last_refresh': 0.0,
-				'last_update': 0.0
-			},
-			3: {
-				'message': None,
-				'priority': -1,
-				'client': None,
-				'current': -1,
-				'last_refresh': 0.0,
-				'last_update': 0.0
-			}
-		}
+		# Changes made while the saved state is being loaded aren't saved again
+		self.loading = False
+		
+		# Traces of accepted messages that haven't been sent to their display yet
+		self.pending_traces = {}
+		
+		self.entries = dict((address, EMPTY_ENTRY) for address in range(4))
+		self.playback = dict((address, self.new_playback(EMPTY_ENTRY)) for address in range(4))
+		self.locks = dict((address, threading.Lock()) for address in range(4))
+		self.bus_lock = threading.Lock()
+		self.save_lock = threading.Lock()
 		
 		self.enabled = {
 			0: True,
@@ -164,56 +217,153 @@ class Controller(object):
 			3: False
 		}
 		
+		# Counters for the status file
+		self.stats = dict((address, {
+			'messages': 0,
+			'rejected': 0,
+			'telegrams': 0,
+			'bytes': 0,
+			'last_send': 0.0
+		}) for address in range(4))
+		
 		try:
-			self.load_config()
+			if self.journal:
+				self.load_journal()
+			else:
+				self.load_config()
 		except:
-			if self.VERBOSE:
-				print "Failed to load configuration"
+			logger.info("Failed to load configuration")
+		
+		self.publish_status()
 	
 	def _reverse_prepare_text(self, message):
-		def _do_replace(message):
-			message = message.replace("{", u"ä")
-			message = message.replace("|", u"ö")
-			message = message.replace("}", u"ü")
-			message = message.replace("~", u"ß")
-			message = message.replace("[", u"Ä")
-			message = message.replace("\\", u"Ö")
-			message = message.replace("]", u"Ü")
-			message = message.encode('utf-8')
-			return message
-		
-		try:
-			message = _do_replace(message)
-		except UnicodeDecodeError:
-			message = message.decode('utf-8')
-			message = _do_replace(message)
-		
-		return message
+		return reverse_prepare_text(message)
 	
-	def save_config(self, filename = "ibis.json"):
-		if self.VERBOSE:
-			print "Saving configuration..."
+	def new_playback(self, entry):
+		return {
+			'entry': entry,
+			'current': -1,
+			'last_refresh': 0.0,
+			'last_update': 0.0
+		}
+	
+	@property
+	def buffer(self):
+		"""
+		The entries and playback state of all displays in the format used for
+		the configuration file and the 'buffer' query
+		"""
 		
-		data = {
+		buffer = {}
+		for address in range(4):
+			entry = self.entries[address]
+			playback = self.playback[address]
+			if playback['entry'] is not entry:
+				playback = self.new_playback(entry)
+			
+			buffer[address] = {
+				'message': entry.message,
+				'priority': entry.priority,
+				'client': entry.client,
+				'current': playback['current'],
+				'last_refresh': playback['last_refresh'],
+				'last_update': playback['last_update']
+			}
+		return buffer
+	
+	def get_config(self):
+		return {
 			'buffer': self.buffer,
 			'current_text': self.current_text,
 			'enabled': self.enabled,
 			'stop_indicators': self.stop_indicators,
 		}
+	
+	def save_config(self, filename = "ibis.json"):
+		logger.debug("Saving configuration...")
+		
+		with self.save_lock:
+			if self.journal:
+				self.journal.compact(self.get_config)
+			else:
+				with open(filename, 'w') as f:
+					f.write(json.dumps(self.get_config()))
+		
+		logger.debug("Successfully saved configuration")
+	
+	def publish_status(self):
+		"""
+		Write the current status of all displays to the status file, if there is one
+		"""
+		
+		if not self.status:
+			return
+		
+		displays = []
+		for address in range(4):
+			status = dict(self.stats[address])
+			status['enabled'] = self.enabled[address]
+			status['stop_indicator'] = self.stop_indicators[address]
+			status['text'] = self.current_text[address]
+			displays.append(status)
+		self.status.write(displays)
+	
+	def journal_change(self, change):
+		"""
+		Append a change of the state (see StateJournal.apply for the format) to the journal,
+		if there is one. This has to happen under the lock of the display that was changed,
+		so the changes of a display end up in the journal in the order they were made.
+		Returns True if the journal should be compacted.
+		"""
+		
+		if self.loading or not self.journal:
+			return False
+		return self.journal.append(change)
+	
+	def save_change(self, compact = False):
+		"""
+		Save the state after a change: rewrite the configuration file,
+		or compact the journal if journal_change asked for it
+		"""
 		
-		with open(filename, 'w') as f:
-			f.write(json.dumps(data))
+		if self.loading:
+			return
 		
-		if self.VERBOSE:
-			print "Successfully saved configuration"
+		if not self.journal:
+			self.save_config()
+		elif compact:
+			logger.debug("Compacting the journal...")
+			self.save_config()
 	
 	def load_config(self, filename = "ibis.json"):
-		if self.VERBOSE:
-			print "Loading configuration..."
+		logger.info("Loading configuration...")
 		
 		with open(filename, 'r') as f:
 			data = json.loads(f.read())
 		
+		self.apply_config(data)
+		logger.info("Successfully loaded configuration")
+	
+	def load_journal(self):
+		logger.info("Loading journal...")
+		self.apply_config(self.journal.load())
+		
+		# Start with a fresh snapshot and an empty journal
+		self.save_config()
+		logger.info("Successfully loaded journal")
+	
+	def apply_config(self, data):
+		"""
+		Restore the state from the format written by save_config
+		"""
+		
+		self.loading = True
+		try:
+			self._apply_config(data)
+		finally:
+			self.loading = False
+	
+	def _apply_config(self, data):
 		for address, entry in data['buffer'].iteritems():
 			if entry['message']:
 				self.set_message(int(address), entry['message'], priority = entry.get('priority', 0), client = entry.get('client', None))
@@ -223,18 +373,19 @@ class Controller(object):
 		
 		for address, state in data['enabled'].iteritems():
 			self.set_enabled(int(address), state)
-		
-		if self.VERBOSE:
-			print "Successfully loaded configuration"
 	
 	def set_stop_indicator(self, address, value):
-		self.master.set_stop_indicator(address, value)
-		self.stop_indicators[address] = value
+		with self.locks[address]:
+			# A BusProcessMaster puts this into the same ring buffer as the telegrams
+			with self.bus_lock:
+				self.master.set_stop_indicator(address, value)
+				self.stop_indicators[address] = value
+			compact = self.journal_change({'op': 'stop_indicator', 'address': address, 'value': value})
 		
-		if self.VERBOSE:
-			print "Stop indicator on display %i set to %s" % (address, str(value))
+		logger.info("Stop indicator on display %i set to %s", address, value, extra = {'address': address, 'stop_indicator': value})
 		
-		self.save_config()
+		self.publish_status()
+		self.save_change(compact)
 		return True
 	
 	def set_enabled(self, address, value):
@@ -247,15 +398,17 @@ class Controller(object):
 				self.set_enabled(i, value)
 			return True
 		
-		self.enabled[address] = value
+		with self.locks[address]:
+			self.enabled[address] = value
+			compact = self.journal_change({'op': 'enabled', 'address': address, 'value': value})
 		
-		if not self.enabled[address]:
+		if not value:
 			self.send_text(address, None) # This seems to fail quite often! Why?
 		
-		if self.VERBOSE:
-			print "Power state of display %i changed to %s" % (address, str(value))
+		logger.info("Power state of display %i changed to %s", address, value, extra = {'address': address, 'enabled': value})
 		
-		self.save_config()
+		self.publish_status()
+		self.save_change(compact)
 		return True
 	
 	def get_enabled(self, address):
@@ -269,47 +422,76 @@ class Controller(object):
 		else:
 			return self.enabled.get(address, False)
 	
-	def send_text(self, address, text):
+	def get_max_length(self, address):
+		"""
+		Return the number of characters that can be sent to a display at once
+		"""
+		
+		profile = self.profiles.get(address)
+		return profile.max_length if profile else 36
+	
+	def encode_text(self, address, text):
+		"""
+		Return the telegram that shows the given text on a display
+		"""
+		
+		profile = self.profiles.get(address)
+		telegram = profile.telegram if profile else 'next_stop__003c'
+		return getattr(self.master, "encode_" + telegram)("" if text is None else text)
+	
+	def send_text(self, address, text, telegram = None):
 		"""
 		Send text to a display
+		<telegram> can be the already encoded telegram for the text (see encode_text)
 		"""
 		
+		trace_id = self.pending_traces.pop(address, None) if self.tracer else None
+		if trace_id is not None:
+			self.tracer.mark(trace_id, 'send_text')
+			self.tracer.set_current(trace_id)
+		
 		# Set the address on the multiplexer or send to all displays if address is -1
 		if address == -1:
 			for i in range(4):
 				self.send_text(i, text)
 			return
-		elif address == 0:
-			self.master.device.setDTR(0)
-			self.master.device.setRTS(0)
-		elif address == 1:
-			self.master.device.setDTR(0)
-			self.master.device.setRTS(1)
-		elif address == 2:
-			self.master.device.setDTR(1)
-			self.master.device.setRTS(0)
-		elif address == 3:
-			self.master.device.setDTR(1)
-			self.master.device.setRTS(1)
 		
 		# Truncate the text
 		if text:
-			text = text[:36]
+			text = text[:self.get_max_length(address)]
 		
-		# Send the data
-		self.master.send_next_stop__003c("" if text is None else text)
-		if self.DEBUG:
-			print address, text.encode('utf-8')
+		if telegram is None:
+			telegram = self.encode_text(address, text)
 		
-		# Save the current text
-		self.current_text[address] = self._reverse_prepare_text(text).decode('utf-8') if text else None
+		with self.bus_lock:
+			self.master.select_address(address)
+			
+			if trace_id is not None:
+				self.tracer.mark(trace_id, 'mux')
+			
+			# Send the data
+			self.master.send_raw(telegram)
+			
+			# Save the current text
+			self.current_text[address] = self._reverse_prepare_text(text).decode('utf-8') if text else None
+			
+			stats = self.stats[address]
+			stats['telegrams'] += 1
+			stats['bytes'] += len(telegram)
+			stats['last_send'] = time.time()
+		
+		self.publish_status()
+		if trace_id is not None:
+			self.tracer.set_current(None)
+			self.tracer.finish(trace_id)
+		logger.debug("Sent to display %i: %r", address, text)
 	
-	def set_message(self, address, message, priority = 0, client = None):
+	def set_message(self, address, message, priority = 0, client = None, trace_id = None):
 		"""
 		Set the stuff to be displayed on a display, like a sequence of texts
 		
 		Message Examples
-		
+			
 			Simple text
 				{
 					'type': 'text',
@@ -355,13 +537,29 @@ class Controller(object):
 					],
 					'interval': 5.0
 				}
+			
+			Scrolling text, stepped by the server
+				{
+					'type': 'ticker',
+					'text': "Welcome aboard",
+					'length': 20,
+					'interval': 0.5
+				}
 		
 		Note: The 'interval' property of sequences is used for all messages that don't specify a duration of their own.
+		
+		The 'length' (number of characters visible at once) and 'interval' (minimum time between two steps)
+		properties of tickers are optional, 'length' must be a positive integer. Tickers can't be part of a sequence.
+		The 'interval' of sequences and tickers and the 'duration' of sequence items must be non-negative numbers.
+		Messages that break these rules are rejected (False is returned).
+		
+		If tracing is enabled, <trace_id> is the ID of the request this message came from.
+		It is followed until the message has been sent to the display.
 		"""
 		
 		def _filter_ascii(message):
 			# Filter out everything that's not 7-bit ASCII
-			if message['type'] == 'text':
+			if message['type'] in ('text', 'ticker'):
 				text = ""
 				for char in message['text']:
 					if ord(char) <= 127 or char in [u"ä", u"ö", u"ü", u"Ä", u"Ö", u"Ü", u"ß"]:
@@ -375,15 +573,34 @@ class Controller(object):
 				message['format'] = text
 			return message
 		
-		# Discard messages with a lower priority then the one in the buffer if not sent by the same client
-		current_priority = self.buffer[address]['priority']
-		current_client = self.buffer[address]['client']
-		if priority < current_priority and client != current_client:
-			if self.VERBOSE:
-				print "Discarded message from %s for display %i (Priority was %i, current is %i set by %s)" % (client, address, priority, current_priority, current_client)
+		def _is_number(value):
+			return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+		
+		def _is_valid(message):
+			# Only tickers at the top level get their steps encoded, and they need at least one step
+			if message['type'] == 'ticker':
+				length = message.get('length')
+				interval = message.get('interval')
+				if length is not None and not (_is_number(length) and not isinstance(length, float) and length > 0):
+					return False
+				return interval is None or (_is_number(interval) and interval >= 0)
+			elif message['type'] == 'sequence':
+				# Timing values end up in comparisons in tick, where anything else would raise
+				if not (_is_number(message.get('interval')) and message['interval'] >= 0):
+					return False
+				for msg in message['messages']:
+					duration = msg.get('duration')
+					if msg['type'] == 'ticker' or (duration is not None and not (_is_number(duration) and duration >= 0)):
+						return False
+			return True
+		
+		if not _is_valid(message):
+			logger.info("Discarded invalid message from %s for display %i", client, address, extra = {'address': address, 'client': client})
+			if self.tracer:
+				self.tracer.finish(trace_id, 'invalid')
 			return False
 		
-		if message['type'] == 'text':
+		if message['type'] in ('text', 'ticker'):
 			message = _filter_ascii(message)
 		elif message['type'] == 'time':
 			message = _filter_ascii(message)
@@ -391,39 +608,92 @@ class Controller(object):
 			for index, msg in enumerate(message['messages']):
 				message['messages'][index] = _filter_ascii(message['messages'][index])
 		
-		self.buffer[address]['message'] = message
-		self.buffer[address]['priority'] = priority
-		self.buffer[address]['client'] = client
-		self.buffer[address]['current'] = -1
-		self.buffer[address]['last_refresh'] = 0.0
-		self.buffer[address]['last_update'] = 0.0
+		# Prepare the complete entry before taking the lock
+		layout = self.profiles[address].layout_message(message) if address in self.profiles else message
+		ticker = self.build_ticker(address, message) if message['type'] == 'ticker' else None
+		entry = DisplayEntry(message, layout, ticker, priority, client)
+		
+		with self.locks[address]:
+			# Discard messages with a lower priority then the one in the buffer if not sent by the same client
+			current = self.entries[address]
+			accepted = priority >= current.priority or client == current.client
+			if accepted:
+				self.entries[address] = entry
+				self.stats[address]['messages'] += 1
+				compact = self.journal_change({'op': 'message', 'address': address, 'message': message, 'priority': priority, 'client': client})
+				if self.tracer and trace_id is not None:
+					# Register the trace before a tick can send the new entry.
+					# A message that was replaced before being sent is not followed any further.
+					self.tracer.mark(trace_id, 'set_message')
+					self.tracer.discard(self.pending_traces.pop(address, None))
+					self.pending_traces[address] = trace_id
+			else:
+				self.stats[address]['rejected'] += 1
+		
+		self.publish_status()
+		if not accepted:
+			logger.info("Discarded message from %s for display %i (Priority was %i, current is %i set by %s)", client, address, priority, current.priority, current.client, extra = {'address': address, 'client': client, 'priority': priority})
+			if self.tracer:
+				self.tracer.finish(trace_id, 'rejected')
+			return False
 		
-		if self.VERBOSE:
-			print "Message on display %i set by %s with priority %i: %s" % (address, client, priority, str(message))
+		# The message is only turned into a string if the log level is enabled (in the logging thread)
+		logger.info("Message on display %i set by %s with priority %i: %s", address, client, priority, message, extra = {'address': address, 'client': client, 'priority': priority})
 		
-		self.save_config()
+		self.save_change(compact)
+		
+		if self.tracer:
+			self.tracer.mark(trace_id, 'save_config')
 		
 		return True
 	
-	def send_message(self, address, message):
+	def build_ticker(self, address, message):
+		"""
+		Prepare the steps of a ticker message, with the telegram of each step encoded in advance
+		"""
+		
+		length = min(message.get('length') or self.TICKER_LENGTH, self.get_max_length(address))
+		
+		# The text comes in from the right and leaves on the left
+		padded = " " * length + message['text'] + " " * length
+		frames = [padded[index:index + length] for index in range(1, len(message['text']) + length + 1)]
+		
+		return {
+			'frames': frames,
+			'telegrams': [self.encode_text(address, frame) for frame in frames],
+		}
+	
+	def get_ticker_interval(self, ticker, message):
+		"""
+		Return the time between two steps of a ticker, which is limited by the bus time
+		it may use: all running tickers together only get TICKER_BUS_SHARE of the bus,
+		so the other displays can still be updated.
+		"""
+		
+		airtime = len(ticker['telegrams'][0]) * self.master.BYTE_TIME
+		active = sum(1 for i in range(4) if self.enabled[i] and self.entries[i].ticker)
+		return max(message.get('interval') or 0.0, airtime * active / self.TICKER_BUS_SHARE)
+	
+	def send_message(self, address, message, state):
 		"""
 		Send a single message of various types
+		<state> is the playback state of the display (see tick), which gets updated
 		"""
 		
 		now = time.time()
 		current_text = self.current_text[address]
-		last_refresh = self.buffer[address]['last_refresh']
-		last_update = self.buffer[address]['last_update']
+		last_refresh = state['last_refresh']
+		last_update = state['last_update']
 		
 		if message:
 			if message['type'] == 'text':
 				if current_text != message['text']:
 					self.send_text(address, message['text'])
-					self.buffer[address]['last_refresh'] = now
-					self.buffer[address]['last_update'] = now
+					state['last_refresh'] = now
+					state['last_update'] = now
 				elif last_refresh + self.TIMEOUT <= now:
 					self.send_text(address, current_text)
-					self.buffer[address]['last_refresh'] = now
+					state['last_refresh'] = now
 			elif message['type'] == 'time':
 				try:
 					text = time.strftime(message['format'])
@@ -431,15 +701,23 @@ class Controller(object):
 					text = time.strftime(message['format'].encode('utf-8'))
 				if current_text != text:
 					self.send_text(address, text)
-					self.buffer[address]['last_refresh'] = now
-					self.buffer[address]['last_update'] = now
+					state['last_refresh'] = now
+					state['last_update'] = now
 				elif last_refresh + self.TIMEOUT <= now:
 					self.send_text(address, current_text)
-					self.buffer[address]['last_refresh'] = now
+					state['last_refresh'] = now
+			elif message['type'] == 'ticker':
+				ticker = state['entry'].ticker
+				if last_update + self.get_ticker_interval(ticker, message) <= now:
+					current = (state['current'] + 1) % len(ticker['frames'])
+					state['current'] = current
+					self.send_text(address, ticker['frames'][current], ticker['telegrams'][current])
+					state['last_refresh'] = now
+					state['last_update'] = now
 			elif message['type'] == 'sequence':
 				default_interval = message['interval']
 				messages = message['messages']
-				current = self.buffer[address]['current']
+				current = state['current']
 				if current == -1 or current >= len(messages) - 1:
 					next_message = 0
 				else:
@@ -448,15 +726,15 @@ class Controller(object):
 				if duration is None:
 					duration = default_interval
 				if last_update + duration <= now:
-					self.buffer[address]['current'] = next_message
-					self.send_message(address, messages[next_message])
+					state['current'] = next_message
+					self.send_message(address, messages[next_message], state)
 				elif last_refresh + self.TIMEOUT <= now:
 					self.send_text(address, current_text)
-					self.buffer[address]['last_refresh'] = now
+					state['last_refresh'] = now
 		else:
 			if current_text is not None:
 				self.send_text(address, None)
-				self.buffer[address]['last_update'] = now
+				state['last_update'] = now
 	
 	def selftest(self):
 		self.send_text(-1, None)
@@ -481,17 +759,42 @@ class Controller(object):
 		for i in range(4):
 			self.set_stop_indicator(i, False)
 	
+	def tick(self):
+		"""
+		Check what's in the buffer once and update the displays if necessary
+		"""
+		
+		for address in range(4):
+			try:
+				self.tick_display(address)
+			except Exception:
+				# A broken entry must not keep the other displays (or the next ticks) from being updated
+				logger.exception("Failed to update display %i", address, extra = {'address': address})
+	
+	def tick_display(self, address):
+		if not self.enabled[address]:
+			# The display may have been disabled while its text was being sent
+			if self.current_text[address] is not None:
+				self.send_text(address, None)
+			return
+		
+		# Work on a copy of the playback state and publish it when done
+		entry = self.entries[address]
+		state = self.playback[address]
+		state = dict(state) if state['entry'] is entry else self.new_playback(entry)
+		if self.tracer:
+			# Only the first tick counts, a message may wait for many ticks until it's sent
+			self.tracer.mark(self.pending_traces.get(address), 'tick', once = True)
+		self.send_message(address, entry.layout, state)
+		self.playback[address] = state
+	
 	def process_buffer(self):
 		"""
 		Periodically check what's in the buffer and update the displays if necessary
 		"""
 		
 		while self.running:
-			for address in range(4):
-				if self.enabled[address]:
-					data = self.buffer[address]
-					message = data['message']
-					self.send_message(address, message)
+			self.tick()
 			time.sleep(0.1)
 	
 	def run(self):
@@ -503,18 +806,61 @@ class Controller(object):
 		self.running = False
 
 class Server(object):
-	def __init__(self, serial_port, port = 4242, timeout = 120, gpio_pinmap = {}, verbose = False, debug = False, selftest = False):
-		self.master = ibis.IBISMaster(serial_port, gpio_pinmap = gpio_pinmap)
-		self.controller = Controller(self.master)
+	def __init__(self, serial_port, port = 4242, timeout = 120, gpio_pinmap = {}, verbose = False, debug = False, selftest = False, trace = False, trace_size = 1000, master = None, profiles = None, bus_process = False, log_json = False, journal = False, status_file = None):
+		"""
+		If <master> is given, it is used instead of an IBISMaster on <serial_port>,
+		e.g. a simulation.SimulatedMaster to run without hardware
+		<profiles> are the display profiles for the layout stage (see Controller)
+		If <bus_process> is True, the serial port is driven by a separate process
+		(see ibis_busprocess)
+		<verbose> and <debug> set the log level to INFO or DEBUG instead of WARNING.
+		Log messages are written by a background thread (see ibis_logging),
+		as JSON lines if <log_json> is True.
+		If <journal> is True, changes are appended to ibis.json.journal, which is
+		compacted into ibis.json from time to time (see ibis_journal)
+		If <status_file> is given, the status of the displays is published to that file
+		for local readers (see ibis_status)
+		"""
+		
+		self.log_handler = setup_logging(logging.DEBUG if debug else logging.INFO if verbose else logging.WARNING, json_lines = log_json)
+		self.tracer = Tracer(size = trace_size) if trace else None
+		if master is None and bus_process:
+			master = BusProcessMaster(serial_port, gpio_pinmap = gpio_pinmap, tracer = self.tracer, refresh_timeout = timeout)
+		elif master is None:
+			master = ibis.IBISMaster(serial_port, gpio_pinmap = gpio_pinmap, tracer = self.tracer)
+		elif self.tracer:
+			master.tracer = self.tracer
+		self.master = master
+		self.controller = Controller(self.master, tracer = self.tracer, profiles = profiles, journal = StateJournal("ibis.json") if journal else None, status = StatusWriter(status_file) if status_file else None)
 		self.controller.TIMEOUT = timeout
-		self.controller.VERBOSE = verbose
-		self.controller.DEBUG = debug
 		
 		if selftest:
 			self.controller.selftest()
 		
-		self.listener = Listener(self.controller, port = port)
+		self.listener = Listener(self.controller, port = port, tracer = self.tracer)
 	
 	def run(self):
-		thread.start_new_thread(self.controller.run, ())
-		self.listener.run()
\ No newline at end of file
+		self.controller_thread = threading.Thread(target = self.controller.run, name = "controller")
+		self.controller_thread.daemon = True
+		self.controller_thread.start()
+		try:
+			self.listener.run()
+		finally:
+			self.close()
+	
+	def close(self):
+		"""
+		Stop the listener and the controller, save the state and close the serial port
+		(which stops the bus process once it has sent everything)
+		"""
+		
+		self.listener.quit()
+		self.controller.quit()
+		if getattr(self, 'controller_thread', None):
+			self.controller_thread.join()
+		
+		self.master.close()
+		if self.controller.journal:
+			self.controller.journal.close()
+		if self.controller.status:
+			self.controller.status.close()
\ No newline at end of file
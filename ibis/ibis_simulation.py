@@ -6,10 +6,86 @@ Tool to graphically simulate the text display
 (For now, it's specific to the kind of display I have, feel free to modify the font files to suit your needs)
 """
 
+import collections
+import hashlib
+import itertools
 import json
+import multiprocessing
+import numpy as np
 import os
+import StringIO
+import struct
+import threading
+import time
 from PIL import Image, ImageDraw
 
+from .ibis_bus import VirtualBus
+from .ibis_decoder import parse_telegram
+from .ibis_protocol import IBISMaster
+
+COMPILED_FONT_MAGIC = "IBISFONT"
+COMPILED_FONT_VERSION = 1
+
+# Magic, version, height, number of glyphs, atlas width, bytes per atlas row
+COMPILED_FONT_HEADER = struct.Struct("<8sHHIII")
+COMPILED_FONT_GLYPH = np.dtype([('codepoint', '<u4'), ('x', '<u4'), ('width', '<u2'), ('height', '<u2')])
+
+"""
+Output formats:
+
+png     PNG image
+rgb     Raw 8-bit RGB pixels, row by row
+grey    Raw 8-bit greyscale pixels, row by row
+bits    The dot matrix, one bit per dot (1 = active), each row padded to full bytes
+pbm     The dot matrix as a binary PBM image (1 = active)
+pgm     Greyscale pixels as a binary PGM image
+"""
+OUTPUT_FORMATS = ('png', 'rgb', 'grey', 'bits', 'pbm', 'pgm')
+
+def open_output(filename):
+	"""
+	Open a file for writing, given as a str or unicode path which may start with ~
+	"""
+	
+	if isinstance(filename, unicode):
+		filename = filename.encode('utf-8')
+	return open(os.path.expanduser(filename), 'wb')
+
+def write_output(data, outfile):
+	"""
+	Write data to a filename, a file-like object or a writable buffer (e.g. a bytearray)
+	"""
+	
+	if isinstance(outfile, (bytearray, memoryview)):
+		if len(outfile) < len(data):
+			raise ValueError("Buffer too small (%i bytes needed, %i available)" % (len(data), len(outfile)))
+		outfile[:len(data)] = data
+	elif isinstance(outfile, basestring):
+		with open_output(outfile) as f:
+			f.write(data)
+	else:
+		outfile.write(data)
+	
+	return len(data)
+
+def _scan_file_worker(job):
+	"""
+	Scan a single file in a worker process (see DisplayFontScanner.scan_font)
+	"""
+	
+	dotsize, dotspacing, filename = job
+	try:
+		return DisplayFontScanner(dotsize, dotspacing).scan_file(filename)
+	except:
+		return None
+
+def _to_unicode(name):
+	return name.decode('utf-8') if isinstance(name, str) else name
+
+def _get_file_hash(filename):
+	with open(filename, 'rb') as f:
+		return hashlib.sha1(f.read()).hexdigest()
+
 class DisplayFontScanner(object):
 	"""
 	Class to scan the PNG files that make up the font and create a representation
@@ -34,7 +110,7 @@ class DisplayFontScanner(object):
 		real_y = (self.dotspacing / 2) + y * self.dotspacing + (y + 1) * self.dotsize - (self.dotsize / 2)
 		
 		return real_x, real_y
-		
+	
 	def get_dot(self, image, x, y):
 		"""
 		Get the state of the dot at the given coordinates
@@ -55,21 +131,26 @@ class DisplayFontScanner(object):
 		width = divmod(image.size[0], (self.dotsize + self.dotspacing))[0]
 		height = divmod(image.size[1], (self.dotsize + self.dotspacing))[0]
 		
-		dots = []
-		for y in range(height):
-			row = []
-			for x in range(width):
-				row.append(self.get_dot(image, x, y))
-			dots.append(row)
+		if len(image.getbands()) < 3:
+			# Same as get_dot, which can't tell grey from colored dots here
+			raise ValueError("Font images must have at least three color bands")
+		
+		# Sample the center pixel of every dot at once instead of calling get_dot for each
+		pixels = np.asarray(image.convert("RGB"))
+		real_x = np.array([self.get_real_coordinates(x, 0)[0] for x in range(width)], dtype = np.intp)
+		real_y = np.array([self.get_real_coordinates(0, y)[1] for y in range(height)], dtype = np.intp)
+		samples = pixels[real_y[:, np.newaxis], real_x[np.newaxis, :]]
+		r, g, b = samples[..., 0], samples[..., 1], samples[..., 2]
+		dots = ~((r == g) & (g == b)) # Check if dot is gray
 		
 		char_data = {
 			'width': width,
 			'height': height,
-			'dots': dots,
+			'dots': dots.tolist(),
 		}
 		
 		return char_data
-		
+	
 	def scan_file(self, filename):
 		"""
 		Scan a single PNG file and build the character data for it
@@ -80,27 +161,106 @@ class DisplayFontScanner(object):
 		
 		return char_data
 	
-	def scan_font(self, fontdir, outfile):
+	def get_index_filename(self, outfile):
+		return outfile + ".index"
+	
+	def load_index(self, outfile):
+		"""
+		Load the fontmap written by a previous scan together with its index,
+		which records the mtime, size and SHA1 hash of every scanned file.
+		Returns (None, None) if there is no usable previous scan.
+		"""
+		
+		try:
+			with open(self.get_index_filename(outfile), 'r') as f:
+				index = json.load(f)
+			with open(outfile, 'r') as f:
+				fontmap = json.load(f)
+		except (IOError, ValueError):
+			return None, None
+		
+		if index.get('dotsize') != self.dotsize or index.get('dotspacing') != self.dotspacing:
+			return None, None
+		
+		return index['files'], fontmap
+	
+	def scan_font(self, fontdir, outfile, compiled_outfile = None, processes = None, incremental = False):
 		"""
 		Scan the font folder and build the font map
+		If <compiled_outfile> is given, a compiled font is written there as well
+		The files are scanned by a pool of <processes> worker processes
+		(default: one per CPU, 1 scans in the current process).
+		If <incremental> is True, only files that changed since the last scan
+		into <outfile> are scanned again.
 		"""
 		
 		fontmap = {}
 		files = [os.path.join(fontdir, filename) for filename in os.listdir(fontdir)]
 		
+		old_files, old_fontmap = self.load_index(outfile) if incremental else (None, None)
+		new_files = {}
+		to_scan = []
+		
 		for filename in files:
 			char_name = os.path.basename(filename)[:-4]
-			try:
-				char_data = self.scan_file(filename)
-			except:
-				continue
 			if char_name == "slash":
 				char_name = "/"
-			fontmap[char_name] = char_data
+			
+			try:
+				stat = os.stat(filename)
+			except OSError:
+				continue
+			key = _to_unicode(os.path.basename(filename))
+			entry = {'mtime': stat.st_mtime, 'size': stat.st_size, 'sha1': None}
+			old_entry = old_files.get(key) if old_files else None
+			old_char = old_fontmap.get(_to_unicode(char_name)) if old_fontmap else None
+			
+			if old_entry and old_entry['size'] == entry['size']:
+				if old_entry['mtime'] != entry['mtime']:
+					# Touched, but maybe not changed
+					entry['sha1'] = _get_file_hash(filename)
+				if old_entry['mtime'] == entry['mtime'] or old_entry['sha1'] == entry['sha1']:
+					entry['sha1'] = old_entry['sha1']
+					new_files[key] = entry
+					if old_char is not None:
+						fontmap[char_name] = old_char
+					continue
+			
+			new_files[key] = entry
+			to_scan.append((filename, char_name))
+		
+		jobs = [(self.dotsize, self.dotspacing, filename) for filename, char_name in to_scan]
+		if processes == 1 or len(jobs) < 2:
+			results = map(_scan_file_worker, jobs)
+		else:
+			pool = multiprocessing.Pool(processes)
+			try:
+				results = pool.map(_scan_file_worker, jobs, chunksize = max(1, len(jobs) // (4 * (processes or multiprocessing.cpu_count()))))
+			finally:
+				pool.close()
+				pool.join()
+		
+		for (filename, char_name), char_data in zip(to_scan, results):
+			key = _to_unicode(os.path.basename(filename))
+			if new_files[key]['sha1'] is None:
+				new_files[key]['sha1'] = _get_file_hash(filename)
+			if char_data is not None:
+				fontmap[char_name] = char_data
 		
 		with open(outfile, 'w') as f:
 			json.dump(fontmap, f)
 		
+		index = {
+			'dotsize': self.dotsize,
+			'dotspacing': self.dotspacing,
+			'files': new_files,
+		}
+		with open(self.get_index_filename(outfile), 'w') as f:
+			json.dump(index, f)
+		
+		if compiled_outfile:
+			FontData.from_fontmap(fontmap).save_compiled(compiled_outfile)
+		
 		return fontmap
 
 class DisplayFontGenerator(object):
@@ -109,6 +269,9 @@ class DisplayFontGenerator(object):
 	Generates images from a fontmap.
 	"""
 	
+	# Rendered dot sprites, keyed by dot size, spacing and colors
+	sprite_cache = {}
+	
 	def __init__(self, dotsize = 47, dotspacing = 8):
 		self.dotsize = dotsize
 		self.dotspacing = dotspacing
@@ -135,9 +298,100 @@ class DisplayFontGenerator(object):
 		
 		return x0, y0, x1, y1
 	
-	def generate_image(self, char_data, outfile, inactive_color, active_color, bg_color):
+	def get_sprites(self, inactive_color, active_color, bg_color, mode = "RGB"):
 		"""
-		Generate a single image from a character map.
+		Return arrays containing one cell (a dot and the space around it) for an
+		inactive and an active dot, or None if the dots don't fit into their cells
+		(in that case, they have to be drawn one by one).
+		<mode> is the PIL image mode of the sprites ("RGB" or "L").
+		"""
+		
+		key = (self.dotsize, self.dotspacing, repr(inactive_color), repr(active_color), repr(bg_color), mode)
+		if key in self.sprite_cache:
+			return self.sprite_cache[key]
+		
+		# Draw the dot in the middle of a 3x3 cell image exactly like it would
+		# be drawn in a full image and check that it stays inside its cell
+		cell = self.dotsize + self.dotspacing
+		sprites = []
+		for color in (inactive_color, active_color):
+			image = Image.new("RGB", (3 * cell, 3 * cell), bg_color)
+			draw = ImageDraw.Draw(image)
+			center_x, center_y = self.get_real_coordinates(1, 1)
+			draw.ellipse(self.get_bounding_box(center_x, center_y, self.dotsize), fill = color)
+			
+			pixels = np.asarray(image.convert(mode))
+			surroundings = pixels.copy()
+			surroundings[cell:2 * cell, cell:2 * cell] = pixels[0, 0]
+			if (surroundings != pixels[0, 0]).any():
+				sprites = None
+				break
+			sprites.append(pixels[cell:2 * cell, cell:2 * cell].copy())
+		
+		self.sprite_cache[key] = sprites
+		return sprites
+	
+	def draw_pixels(self, char_data, inactive_color, active_color, bg_color, mode = "RGB"):
+		"""
+		Draw a character map into an array of pixels by tiling pre-rendered dot sprites
+		The array has the shape (height, width, 3) for mode "RGB" and (height, width) for mode "L"
+		"""
+		
+		dots = np.asarray(char_data['dots'], dtype = bool)
+		sprites = None
+		if self.dotsize > 1 and dots.shape == (char_data['height'], char_data['width']):
+			sprites = self.get_sprites(inactive_color, active_color, bg_color, mode)
+		
+		if not sprites:
+			image = self.draw_image_ellipses(char_data, inactive_color, active_color, bg_color)
+			return np.asarray(image.convert(mode))
+		
+		inactive, active = sprites
+		cell = inactive.shape[0]
+		height, width = dots.shape
+		
+		# Pick the sprite for each dot; the result has the shape
+		# (dot row, pixel row in cell, dot column, pixel column in cell[, channel])
+		extra = (None, ) * (inactive.ndim - 2)
+		selector = dots[(slice(None), None, slice(None), None) + extra]
+		pixels = np.where(selector, active[None, :, None], inactive[None, :, None])
+		return np.ascontiguousarray(pixels, dtype = np.uint8).reshape((height * cell, width * cell) + inactive.shape[2:])
+	
+	def draw_image(self, char_data, inactive_color, active_color, bg_color):
+		"""
+		Draw a character map into a PIL Image by tiling pre-rendered dot sprites
+		"""
+		
+		return Image.fromarray(self.draw_pixels(char_data, inactive_color, active_color, bg_color), "RGB")
+	
+	def encode(self, char_data, format, inactive_color, active_color, bg_color):
+		"""
+		Return the character map in the given output format (see OUTPUT_FORMATS)
+		"""
+		
+		if format == 'png':
+			buf = StringIO.StringIO()
+			self.draw_image(char_data, inactive_color, active_color, bg_color).save(buf, "PNG")
+			return buf.getvalue()
+		elif format == 'rgb':
+			return self.draw_pixels(char_data, inactive_color, active_color, bg_color).tostring()
+		elif format in ('grey', 'pgm'):
+			pixels = self.draw_pixels(char_data, inactive_color, active_color, bg_color, mode = "L")
+			if format == 'grey':
+				return pixels.tostring()
+			return "P5\n%i %i\n255\n" % (pixels.shape[1], pixels.shape[0]) + pixels.tostring()
+		elif format in ('bits', 'pbm'):
+			dots = np.asarray(char_data['dots'], dtype = bool).reshape(char_data['height'], char_data['width'])
+			packed = np.packbits(dots, axis = 1).tostring()
+			if format == 'bits':
+				return packed
+			return "P4\n%i %i\n" % (char_data['width'], char_data['height']) + packed
+		
+		raise ValueError("Unknown output format: %s" % format)
+	
+	def draw_image_ellipses(self, char_data, inactive_color, active_color, bg_color):
+		"""
+		Draw a character map into a PIL Image one dot at a time
 		"""
 		
 		width = char_data['width']
@@ -162,48 +416,260 @@ class DisplayFontGenerator(object):
 				else:
 					draw.point((x, y), fill = color)
 		
-		if type(outfile) is str:
-			with open(outfile.encode('utf-8'), 'wb') as f:
-				image.save(f, "PNG")
-		else:
-			image.save(outfile, "PNG")
+		return image
+	
+	def generate_image(self, char_data, outfile, inactive_color, active_color, bg_color, format = 'png'):
+		"""
+		Generate a single image from a character map.
+		<outfile> can be a filename, a file-like object or a writable buffer.
+		Returns the number of bytes written.
+		"""
+		
+		return write_output(self.encode(char_data, format, inactive_color, active_color, bg_color), outfile)
 	
 	def generate_font(self, fontmap_file, outdir, inactive_color = (64, 64, 64), active_color = (192, 255, 0), bg_color = (0, 0, 0)):
 		"""
 		Generate all images for a given fontmap
 		"""
 		
-		with open(fontmap_file, 'r') as f:
-			fontmap = json.load(f)
+		fontmap = FontData.load(fontmap_file).get_fontmap()
 		
 		for char, char_data in fontmap.iteritems():
 			name = ("slash" if char == "/" else char) + ".png"
 			filename = os.path.join(outdir, name)
 			self.generate_image(char_data, filename, inactive_color, active_color, bg_color)
 
+class FontData(object):
+	"""
+	The glyphs of a font in a single boolean array (the atlas) with all glyphs
+	side by side, plus width tables indexed by code point.
+	
+	Fonts can be loaded from a JSON fontmap or from a compiled font file.
+	Compiled fonts contain a header, a glyph table and the bit-packed atlas
+	and are memory-mapped instead of parsed.
+	
+	Use FontData.load to share the data of a file between all DisplayFonts
+	in the process. <source> then is the path and mtime of the file.
+	"""
+	
+	cache = {}
+	cache_lock = threading.Lock()
+	source = None
+	
+	def __init__(self, chars, widths, heights, atlas):
+		self.widths = dict(zip(chars, widths))
+		self.heights = dict(zip(chars, heights))
+		self.height = atlas.shape[0]
+		self.atlas = atlas
+		self.glyphs = {}
+		self.offsets = {}
+		
+		x = 0
+		for char, width in zip(chars, widths):
+			self.glyphs[char] = self.atlas[:, x:x + width]
+			self.offsets[char] = x
+			x += width
+		
+		self.build_width_table()
+	
+	@classmethod
+	def load(cls, filename):
+		"""
+		Load a fontmap or compiled font, or return the already loaded data for it
+		"""
+		
+		path = os.path.realpath(os.path.expanduser(filename))
+		key = (path, os.path.getmtime(path))
+		with cls.cache_lock:
+			data = cls.cache.get(key)
+			if data is None:
+				with open(path, 'rb') as f:
+					compiled = f.read(len(COMPILED_FONT_MAGIC)) == COMPILED_FONT_MAGIC
+				
+				if compiled:
+					data = cls.from_compiled(path)
+				else:
+					with open(path, 'r') as f:
+						data = cls.from_fontmap(json.load(f))
+				data.source = key
+				cls.cache[key] = data
+			return data
+	
+	@classmethod
+	def from_fontmap(cls, fontmap):
+		# Fontmaps built by scan_font have UTF-8 encoded keys instead of unicode
+		fontmap = dict((_to_unicode(char), char_data) for char, char_data in fontmap.iteritems())
+		chars = sorted(fontmap.keys())
+		widths = [fontmap[char]['width'] for char in chars]
+		heights = [fontmap[char]['height'] for char in chars]
+		atlas = np.zeros((max(heights or [0]), sum(widths)), dtype = bool)
+		
+		x = 0
+		for char, width in zip(chars, widths):
+			dots = np.array(fontmap[char]['dots'], dtype = bool).reshape(-1, width)
+			atlas[:dots.shape[0], x:x + width] = dots
+			x += width
+		
+		return cls(chars, widths, heights, atlas)
+	
+	@classmethod
+	def from_compiled(cls, filename):
+		data = np.memmap(filename, dtype = np.uint8, mode = 'r')
+		magic, version, height, count, atlas_width, row_bytes = COMPILED_FONT_HEADER.unpack_from(data[:COMPILED_FONT_HEADER.size].tostring())
+		if magic != COMPILED_FONT_MAGIC or version != COMPILED_FONT_VERSION:
+			raise ValueError("%s is not a compiled font of version %i" % (filename, COMPILED_FONT_VERSION))
+		
+		offset = COMPILED_FONT_HEADER.size
+		table = data[offset:offset + count * COMPILED_FONT_GLYPH.itemsize].view(COMPILED_FONT_GLYPH)
+		offset += count * COMPILED_FONT_GLYPH.itemsize
+		packed = data[offset:offset + height * row_bytes].reshape(height, row_bytes)
+		atlas = np.unpackbits(packed, axis = 1)[:, :atlas_width].astype(bool)
+		
+		chars = [unichr(codepoint) for codepoint in table['codepoint']]
+		return cls(chars, table['width'].tolist(), table['height'].tolist(), atlas)
+	
+	def save_compiled(self, filename):
+		"""
+		Write the font in the compiled format
+		"""
+		
+		# Characters are stored by code point, so only single characters are supported
+		chars = sorted(char for char in self.glyphs if len(char) == 1)
+		table = np.zeros(len(chars), dtype = COMPILED_FONT_GLYPH)
+		packed = np.packbits(self.atlas, axis = 1)
+		
+		for index, char in enumerate(chars):
+			table[index] = (ord(char), self.offsets[char], self.widths[char], self.heights[char])
+		
+		with open(filename, 'wb') as f:
+			f.write(COMPILED_FONT_HEADER.pack(COMPILED_FONT_MAGIC, COMPILED_FONT_VERSION, self.height, len(chars), self.atlas.shape[1], packed.shape[1]))
+			f.write(table.tostring())
+			f.write(packed.tostring())
+	
+	def get_fontmap(self):
+		"""
+		Return the font in the fontmap format
+		"""
+		
+		fontmap = {}
+		for char, glyph in self.glyphs.iteritems():
+			height = self.heights[char]
+			fontmap[char] = {
+				'width': self.widths[char],
+				'height': height,
+				'dots': glyph[:height].tolist(),
+			}
+		return fontmap
+	
+	def build_width_table(self):
+		"""
+		Build arrays indexed by code point holding the width of each character
+		and whether it exists in this font
+		"""
+		
+		chars = [char for char in self.widths if len(char) == 1]
+		size = max([ord(char) for char in chars] or [0]) + 1
+		self.width_table = np.zeros(size, dtype = np.int32)
+		self.present_table = np.zeros(size, dtype = bool)
+		for char in chars:
+			self.width_table[ord(char)] = self.widths[char]
+			self.present_table[ord(char)] = True
+
 class DisplayFont(object):
 	"""
 	This class represents a display font used to display text.
+	
+	<fontmap_file> can be a JSON fontmap or a compiled font. Each file is only
+	loaded once per process, no matter how many DisplayFonts use it.
 	"""
 	
 	def __init__(self, fontmap_file, spacing):
 		self.fontmap_file = fontmap_file
 		self.spacing = spacing
-		with open(self.fontmap_file, 'r') as f:
-			self.fontmap = json.load(f)
+		self.data = FontData.load(self.fontmap_file)
+		
+		self.height = self.data.height
+		self.widths = self.data.widths
+		self.atlas = self.data.atlas
+		self.glyphs = self.data.glyphs
+		self.width_table = self.data.width_table
+		self.present_table = self.data.present_table
+	
+	@property
+	def fontmap(self):
+		return self.data.get_fontmap()
+	
+	def get_codepoints(self, text):
+		"""
+		Convert the text into an array of code points, with code points
+		outside of the width table mapped to 0
+		"""
+		
+		codes = np.fromiter((ord(char) for char in text), dtype = np.int32, count = len(text))
+		return self.clip_codepoints(codes)
+	
+	def clip_codepoints(self, codes):
+		return np.where(codes < len(self.width_table), codes, 0)
+	
+	def get_step_widths(self, codes):
+		"""
+		Return the width every character adds to a text including the spacing after it,
+		as well as the presence flags
+		"""
+		
+		present = self.present_table[codes]
+		return present * (self.width_table[codes] + self.spacing), present
 	
 	def get_width(self, text):
+		widths = self.widths
 		length = len(text)
 		width = 0
 		for index, char in enumerate(text):
-			if char in self.fontmap.keys():
-				char_data = self.fontmap[char]
-				width += char_data['width']
+			if char in widths:
+				width += widths[char]
 				if index < length - 1:
 					width += self.spacing
 		
 		return width
 	
+	def get_prefix_widths(self, text):
+		"""
+		Return an array whose n-th element is the width of text[:n]
+		"""
+		
+		steps, present = self.get_step_widths(self.get_codepoints(text))
+		prefix_widths = np.zeros(len(text) + 1, dtype = np.int64)
+		np.cumsum(steps, out = prefix_widths[1:])
+		
+		# The last character of each prefix isn't followed by spacing
+		prefix_widths[1:] -= present * self.spacing
+		return prefix_widths
+	
+	def get_fitting_length(self, text, max_width):
+		"""
+		Return the length of the longest prefix of the text that is at most <max_width> dots wide
+		"""
+		
+		# The prefix widths never decrease, so they can be searched with bisection
+		prefix_widths = self.get_prefix_widths(text)
+		return int(np.searchsorted(prefix_widths, max_width, side = 'right')) - 1
+	
+	def get_widths(self, codes, starts, ends):
+		"""
+		Return the widths of many texts at once.
+		<codes> is the concatenation of the texts' code points, <starts> and <ends>
+		are arrays of the start and end index of each text in <codes>.
+		"""
+		
+		steps, present = self.get_step_widths(codes)
+		cumulative = np.zeros(len(codes) + 1, dtype = np.int64)
+		np.cumsum(steps, out = cumulative[1:])
+		
+		widths = cumulative[ends] - cumulative[starts]
+		nonempty = ends > starts
+		widths[nonempty] -= present[ends[nonempty] - 1] * self.spacing
+		return widths
+	
 	def get_nominal_width(self, text = "ABCDEabcde12345"):
 		"""
 		Calculate the average character width, used for sorting fonts based on the
@@ -214,51 +680,162 @@ class DisplayFont(object):
 		
 		return avg_width
 	
-	def generate_text_data(self, text):
+	def render_text(self, text):
 		"""
-		Generate dot data for an image representing the given text
+		Render the given text into a boolean array of shape (height, width)
 		"""
 		
-		text_dots = []
+		glyphs = self.glyphs
+		length = len(text)
+		chars = [(index, glyphs[char]) for index, char in enumerate(text) if char in glyphs]
 		
-		for index, char in enumerate(text):
-			if char not in self.fontmap.keys():
-				continue
-			
-			char_data = self.fontmap[char]
-			dots = char_data['dots']
-			
-			for y, row in enumerate(dots):
-				try:
-					text_dots[y] += row
-				except IndexError:
-					text_dots.append(row[:]) # WITHOUT THE [:] SHIT GOES TO HELL
-				
-				if index < len(text) - 1:
-					text_dots[y] += [False] * self.spacing
+		width = 0
+		for index, glyph in chars:
+			width += glyph.shape[1]
+			if index < length - 1:
+				width += self.spacing
 		
-		width = len(text_dots[0])
-		height = len(text_dots)
+		dots = np.zeros((self.height, width), dtype = bool)
+		x = 0
+		for index, glyph in chars:
+			glyph_width = glyph.shape[1]
+			dots[:, x:x + glyph_width] = glyph
+			x += glyph_width
+			if index < length - 1:
+				x += self.spacing
+		
+		return dots
+	
+	def generate_text_data(self, text):
+		"""
+		Generate dot data for an image representing the given text
+		"""
+		
+		dots = self.render_text(text)
 		
 		text_data = {
-			'width': width,
-			'height': height,
-			'dots': text_dots,
+			'width': dots.shape[1],
+			'height': dots.shape[0],
+			'dots': dots.tolist(),
 		}
 		
 		return text_data
 
+class RenderCache(object):
+	"""
+	LRU cache for images generated by DisplaySimulator, bounded by the total
+	size of the cached images and dot arrays in bytes.
+	
+	If <cache_dir> is given, every rendered image is also stored there and
+	images that have been evicted from memory are loaded from disk.
+	"""
+	
+	def __init__(self, max_bytes = 16 * 1024 * 1024, cache_dir = None):
+		self.max_bytes = max_bytes
+		self.cache_dir = cache_dir
+		self.entries = collections.OrderedDict()
+		self.size = 0
+		self.hits = 0
+		self.disk_hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+		
+		if self.cache_dir and not os.path.isdir(self.cache_dir):
+			os.makedirs(self.cache_dir)
+	
+	def get_filename(self, key):
+		return os.path.join(self.cache_dir, hashlib.sha1(repr(key)).hexdigest() + ".render")
+	
+	def get(self, key):
+		"""
+		Return the (image data, overflow flag, dots) tuple for the given key or None
+		"""
+		
+		with self.lock:
+			entry = self.entries.pop(key, None)
+			if entry is not None:
+				self.entries[key] = entry
+				self.hits += 1
+				return entry
+		
+		if self.cache_dir:
+			entry = self.load(key)
+			if entry is not None:
+				with self.lock:
+					self.disk_hits += 1
+				self.put(key, *entry, store = False)
+				return entry
+		
+		with self.lock:
+			self.misses += 1
+		return None
+	
+	def put(self, key, data, overflow, dots, store = True):
+		with self.lock:
+			if key in self.entries:
+				old_data, old_overflow, old_dots = self.entries.pop(key)
+				self.size -= len(old_data) + old_dots.nbytes
+			self.entries[key] = (data, overflow, dots)
+			self.size += len(data) + dots.nbytes
+			
+			while self.size > self.max_bytes and self.entries:
+				old_key, (old_data, old_overflow, old_dots) = self.entries.popitem(last = False)
+				self.size -= len(old_data) + old_dots.nbytes
+		
+		if store and self.cache_dir:
+			self.store(key, data, overflow, dots)
+	
+	def store(self, key, data, overflow, dots):
+		# Metadata line, bit-packed dots, image data
+		header = json.dumps({'overflow': overflow, 'height': dots.shape[0], 'width': dots.shape[1]})
+		filename = self.get_filename(key)
+		with open(filename + ".tmp", 'wb') as f:
+			f.write(header + "\n")
+			f.write(np.packbits(dots).tostring())
+			f.write(data)
+		os.rename(filename + ".tmp", filename)
+	
+	def load(self, key):
+		try:
+			with open(self.get_filename(key), 'rb') as f:
+				header = json.loads(f.readline())
+				count = header['height'] * header['width']
+				packed = np.fromstring(f.read((count + 7) // 8), dtype = np.uint8)
+				data = f.read()
+		except (IOError, ValueError):
+			return None
+		
+		dots = np.unpackbits(packed)[:count].astype(bool).reshape(header['height'], header['width'])
+		return data, header['overflow'], dots
+	
+	def get_stats(self):
+		with self.lock:
+			return {
+				'entries': len(self.entries),
+				'bytes': self.size,
+				'hits': self.hits,
+				'disk_hits': self.disk_hits,
+				'misses': self.misses,
+			}
+	
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.size = 0
+
 class DisplaySimulator(object):
 	"""
 	Class that manages DisplayFonts and simulates the graphical display of the real displays
 	
 	The 'fonts' parameter must list the fonts from widest to narrowest font
+	The optional 'cache' parameter is a RenderCache used by generate_image
 	"""
 	
-	def __init__(self, fonts, width = 120, height = 8):
+	def __init__(self, fonts, width = 120, height = 8, cache = None):
 		self.fonts = fonts
 		self.width = width
 		self.height = height
+		self.cache = cache
 	
 	def choose_font(self, text):
 		"""
@@ -271,10 +848,41 @@ class DisplaySimulator(object):
 		
 		return self.fonts[-1] # Return the narrowest font in case no font is small enough
 	
-	def generate_image(self, text, outfile, dotsize = 47, dotspacing = 8, inactive_color = (64, 64, 64), active_color = (192, 255, 0), bg_color = (0, 0, 0)):
+	def fit_texts(self, texts):
 		"""
-		Generate an image representing the given text
-		Returns an overflow flag and the dot data for analytical purposes
+		Choose the font for many texts at once
+		Returns a list of (font, width, overflow) tuples, one for each text
+		(texts are stripped first, just like in render)
+		"""
+		
+		texts = [text.strip() or text for text in texts]
+		lengths = np.array([len(text) for text in texts], dtype = np.int64)
+		ends = np.cumsum(lengths)
+		starts = ends - lengths
+		
+		text = u"".join(texts)
+		codes = np.frombuffer(text.encode('utf-32-le'), dtype = '<u4').astype(np.int32)
+		if len(codes) != len(text):
+			# Narrow Python builds count characters outside the BMP twice
+			codes = np.fromiter((ord(char) for char in text), dtype = np.int32, count = len(text))
+		
+		all_widths = []
+		for font in self.fonts:
+			all_widths.append(font.get_widths(font.clip_codepoints(codes), starts, ends))
+		all_widths = np.array(all_widths)
+		
+		# Use the first (widest) font that fits, or the narrowest one if none does
+		fits = all_widths <= self.width
+		fitting = fits.any(axis = 0)
+		choices = np.where(fitting, fits.argmax(axis = 0), len(self.fonts) - 1)
+		widths = all_widths[choices, np.arange(len(texts))]
+		
+		return [(self.fonts[choice], int(width), not fit) for choice, width, fit in zip(choices, widths, fitting)]
+	
+	def render(self, text):
+		"""
+		Render the given text the way the display would show it
+		Returns an overflow flag and a boolean array of shape (height, width)
 		"""
 		
 		stripped_text = text.strip()
@@ -282,28 +890,223 @@ class DisplaySimulator(object):
 		font = self.choose_font(text)
 		overflow = False
 		
-		while font.get_width(text) > self.width:
+		length = font.get_fitting_length(text, self.width)
+		if length < len(text):
 			overflow = True
-			text = text[:-1]
+			text = text[:length]
+		
+		text_dots = font.render_text(text)[:self.height, :self.width]
+		
+		# Center the text on the display
+		dots = np.zeros((self.height, self.width), dtype = bool)
+		left = (self.width - text_dots.shape[1]) // 2
+		dots[:text_dots.shape[0], left:left + text_dots.shape[1]] = text_dots
+		
+		return overflow, dots
+	
+	def generate_image(self, text, outfile, dotsize = 47, dotspacing = 8, inactive_color = (64, 64, 64), active_color = (192, 255, 0), bg_color = (0, 0, 0), format = 'png', return_length = False):
+		"""
+		Generate an image representing the given text
+		Returns an overflow flag and the dot data for analytical purposes,
+		plus the number of bytes written if <return_length> is True
 		
-		text_data = font.generate_text_data(text)
+		<outfile> can be a filename, a file-like object or a writable buffer.
+		<format> is one of OUTPUT_FORMATS; the raw formats skip image compression.
+		"""
 		
-		for y, row in enumerate(text_data['dots']):
-			if len(row) > self.width:
-				row = row[:self.width]
-			elif len(row) == self.width:
-				pass
+		if self.cache is None:
+			overflow, dots = self.render(text)
+			
+			text_data = {
+				'width': self.width,
+				'height': self.height,
+				'dots': dots,
+			}
+			
+			gen = DisplayFontGenerator(dotsize, dotspacing)
+			length = gen.generate_image(text_data, outfile, inactive_color, active_color, bg_color, format)
+			if return_length:
+				return overflow, dots.tolist(), length
+			return overflow, dots.tolist()
+		
+		# The source includes the mtime of the font file, so a changed font isn't rendered from stale entries
+		fonts = tuple((font.data.source, font.spacing) for font in self.fonts)
+		key = (text, fonts, self.width, self.height, dotsize, dotspacing, repr(inactive_color), repr(active_color), repr(bg_color), format)
+		entry = self.cache.get(key)
+		
+		if entry is None:
+			overflow, dots = self.render(text)
+			
+			text_data = {
+				'width': self.width,
+				'height': self.height,
+				'dots': dots,
+			}
+			
+			gen = DisplayFontGenerator(dotsize, dotspacing)
+			entry = (gen.encode(text_data, format, inactive_color, active_color, bg_color), overflow, dots)
+			self.cache.put(key, *entry)
+		
+		data, overflow, dots = entry
+		length = write_output(data, outfile)
+		if return_length:
+			return overflow, dots.tolist(), length
+		return overflow, dots.tolist()
+	
+	def get_sequence_frames(self, message, now = None):
+		"""
+		Resolve a message like the ones accepted by Controller.set_message into
+		a list of (text, duration) tuples, merging consecutive identical texts
+		"""
+		
+		def _get_text(message):
+			if message['type'] == 'time':
+				try:
+					return time.strftime(message['format'], now)
+				except:
+					return time.strftime(message['format'].encode('utf-8'), now).decode('utf-8')
+			return message['text']
+		
+		if now is None:
+			now = time.localtime()
+		
+		if message['type'] == 'sequence':
+			frames = []
+			for msg in message['messages']:
+				duration = msg.get('duration', None)
+				if duration is None:
+					duration = message['interval']
+				frames.append((_get_text(msg), duration))
+		else:
+			frames = [(_get_text(message), message.get('duration', None) or 1.0)]
+		
+		merged = []
+		for text, duration in frames:
+			if merged and merged[-1][0] == text:
+				merged[-1] = (text, merged[-1][1] + duration)
 			else:
-				diff = self.width - len(row)
-				left = diff / 2
-				right = diff - left
-				text_data['dots'][y] = [False] * left + row + [False] * right
+				merged.append((text, duration))
+		return merged
+	
+	def generate_sequence(self, message, outfile, format = 'GIF', now = None, dotsize = 47, dotspacing = 8, inactive_color = (64, 64, 64), active_color = (192, 255, 0), bg_color = (0, 0, 0)):
+		"""
+		Render a message (usually a sequence) into an animated GIF or PNG (APNG)
+		Each distinct text is rendered only once, no matter how often it appears.
+		<now> is the time tuple used for time messages (defaults to the current time).
+		Returns the list of (text, duration) frames. Raises ValueError for an empty sequence.
+		"""
 		
-		text_data['width'] = self.width
+		Image.init()
+		if format.upper() not in Image.SAVE_ALL:
+			# APNG support was added in Pillow 7.1
+			raise ValueError("This version of PIL can't write animated %s files" % format)
 		
+		frames = self.get_sequence_frames(message, now)
+		if not frames:
+			raise ValueError("The message has nothing to show")
 		gen = DisplayFontGenerator(dotsize, dotspacing)
-		gen.generate_image(text_data, outfile, inactive_color, active_color, bg_color)
-		return overflow, text_data['dots']
+		images = {}
+		
+		def _get_image(text):
+			image = images.get(text)
+			if image is None:
+				overflow, dots = self.render(text)
+				text_data = {'width': self.width, 'height': self.height, 'dots': dots}
+				image = gen.draw_image(text_data, inactive_color, active_color, bg_color)
+				if format.upper() == 'GIF':
+					# Quantize once per distinct frame instead of once per occurrence
+					image = image.convert("P", palette = Image.ADAPTIVE)
+				images[text] = image
+			return image
+		
+		first = _get_image(frames[0][0])
+		rest = (_get_image(text) for text, duration in frames[1:])
+		options = {
+			'save_all': True,
+			'append_images': rest,
+			'duration': [int(duration * 1000) for text, duration in frames],
+			'loop': 0,
+		}
+		
+		if isinstance(outfile, basestring):
+			with open_output(outfile) as f:
+				first.save(f, format, **options)
+		else:
+			first.save(outfile, format, **options)
+		
+		return frames
+
+class SimulatedMaster(IBISMaster):
+	"""
+	Drop-in replacement for IBISMaster (e.g. for the 'master' parameter of Server)
+	that doesn't need any hardware.
+	
+	Everything that is sent goes to a virtual IBIS bus, where the telegrams are
+	decoded per multiplexer address. Whenever the text of a display changes, it is
+	rendered using the given DisplaySimulator and kept in memory as the latest frame
+	of that display. Additional keyword arguments are passed to generate_image.
+	
+	Every instance gets a bus of its own unless <name> is given.
+	"""
+	
+	instances = itertools.count(1)
+	
+	def __init__(self, simulator, name = None, gpio_pinmap = {}, tracer = None, **render_options):
+		self.simulator = simulator
+		self.render_options = render_options
+		self.frames = {}
+		self.stop_indicators = {}
+		self.frames_lock = threading.Lock()
+		
+		if name is None:
+			name = "simulation-%i-%i" % (os.getpid(), next(self.instances))
+		
+		# Only the frames are needed, so the bus doesn't have to keep every telegram
+		IBISMaster.__init__(self, "ibisbus://%s?history=1" % name, gpio_pinmap = gpio_pinmap, tracer = tracer)
+		self.bus = self.device.bus
+		self.bus.add_listener(self.process_telegram)
+	
+	def process_telegram(self, telegram):
+		if not telegram.valid:
+			return
+		
+		text = parse_telegram(telegram.data).fields.get('text')
+		if text is None:
+			return
+		text = u" ".join(text.split())
+		
+		with self.frames_lock:
+			frame = self.frames.get(telegram.address)
+			if frame is not None and frame['text'] == text:
+				return
+		
+		buf = StringIO.StringIO()
+		overflow, dots = self.simulator.generate_image(text, buf, **self.render_options)
+		
+		with self.frames_lock:
+			self.frames[telegram.address] = {
+				'text': text,
+				'overflow': overflow,
+				'data': buf.getvalue(),
+				'timestamp': telegram.timestamp,
+			}
+	
+	def close(self):
+		IBISMaster.close(self)
+		VirtualBus.remove(self.bus.name)
+	
+	def get_frame(self, address):
+		"""
+		Return the latest frame of the given display as a dict with the keys
+		'text', 'overflow', 'data' (the rendered image) and 'timestamp', or None
+		"""
+		
+		with self.frames_lock:
+			return self.frames.get(address)
+	
+	def set_stop_indicator(self, address, value):
+		self.stop_indicators[address] = bool(value)
+		return True
 
 def main():
 	pass
@@ -0,0 +1,168 @@
+# Copyright (C) 2014 Julian Metzler
+# See the LICENSE file for the full license.
+
+"""
+Status of the server in a memory-mapped file, for local readers
+
+The Controller writes the current text, power state, stop indicator and some
+statistics of every display into a file of fixed layout (best put on a tmpfs
+like /dev/shm). Scripts on the same machine can read it with StatusReader
+without talking to the server.
+
+The file starts with a sequence number which the writer makes odd before and
+even again after changing anything. Readers copy the data and check that the
+sequence number was the same even number before and after (a seqlock), so they
+never see a half-written state and never block the server.
+"""
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = "IBST"
+VERSION = 1
+
+# Magic, version, number of displays, record size, sequence number, time of the last update
+HEADER = struct.Struct("<4sBBHQd")
+SEQUENCE = struct.Struct("<Q")
+SEQUENCE_OFFSET = 8
+UPDATED = struct.Struct("<d")
+UPDATED_OFFSET = 16
+
+# Enabled, stop indicator, has text, length of the text, messages set, messages rejected,
+# telegrams sent, bytes sent, time of the last telegram, text (UTF-8)
+TEXT_SIZE = 256
+RECORD = struct.Struct("<BBBH3IQd%is" % TEXT_SIZE)
+
+DISPLAYS = 4
+
+def get_size(displays = DISPLAYS):
+	return HEADER.size + displays * RECORD.size
+
+class StatusWriter(object):
+	"""
+	Publishes the status of the displays to <filename>, which is created if necessary.
+	Writing is thread-safe.
+	"""
+	
+	def __init__(self, filename, displays = DISPLAYS):
+		self.filename = filename
+		self.displays = displays
+		self.size = get_size(displays)
+		self.lock = threading.Lock()
+		self.sequence = 0
+		
+		# The file is never truncated to a smaller size since readers may have mapped it
+		fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0644)
+		try:
+			if os.fstat(fd).st_size < self.size:
+				os.ftruncate(fd, self.size)
+			self.map = mmap.mmap(fd, self.size)
+		finally:
+			os.close(fd)
+		
+		self.map[:HEADER.size] = HEADER.pack(MAGIC, VERSION, displays, RECORD.size, 0, time.time())
+	
+	def write(self, displays):
+		"""
+		Publish the status. <displays> is a list with a dict for every display with the keys
+		enabled, stop_indicator, text, messages, rejected, telegrams, bytes and last_send
+		"""
+		
+		records = []
+		for status in displays:
+			text = (status['text'] or u"").encode('utf-8')[:TEXT_SIZE]
+			records.append(RECORD.pack(
+				status['enabled'],
+				status['stop_indicator'],
+				status['text'] is not None,
+				len(text),
+				status['messages'],
+				status['rejected'],
+				status['telegrams'],
+				status['bytes'],
+				status['last_send'],
+				text
+			))
+		data = "".join(records)
+		
+		with self.lock:
+			self.sequence += 1
+			SEQUENCE.pack_into(self.map, SEQUENCE_OFFSET, self.sequence)
+			UPDATED.pack_into(self.map, UPDATED_OFFSET, time.time())
+			self.map[HEADER.size:HEADER.size + len(data)] = data
+			self.sequence += 1
+			SEQUENCE.pack_into(self.map, SEQUENCE_OFFSET, self.sequence)
+	
+	def close(self):
+		self.map.close()
+
+class StatusReader(object):
+	"""
+	Reads the status published by a server with a status file
+	"""
+	
+	def __init__(self, filename, retries = 1000):
+		self.filename = filename
+		self.retries = retries
+		with open(filename, 'rb') as f:
+			self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		
+		magic, version, self.displays, record_size, sequence, updated = HEADER.unpack_from(self.map, 0)
+		if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+			raise ValueError("%s is not a status file of this version" % filename)
+		if len(self.map) < get_size(self.displays):
+			raise ValueError("%s is too short" % filename)
+	
+	def read_raw(self):
+		"""
+		Return a consistent copy of the header and the records
+		"""
+		
+		for attempt in range(self.retries):
+			sequence = SEQUENCE.unpack_from(self.map, SEQUENCE_OFFSET)[0]
+			if sequence % 2 == 0:
+				data = self.map[:get_size(self.displays)]
+				if SEQUENCE.unpack_from(self.map, SEQUENCE_OFFSET)[0] == sequence:
+					return data
+			# The writer is busy, let it finish
+			time.sleep(0.0001)
+		
+		raise IOError("Could not get a consistent read of %s" % self.filename)
+	
+	def read(self):
+		"""
+		Return the status in the format of Client.get_all (without the buffer),
+		plus the sequence number, the time of the last update and statistics for every display
+		"""
+		
+		data = self.read_raw()
+		magic, version, displays, record_size, sequence, updated = HEADER.unpack_from(data, 0)
+		status = {
+			'sequence': sequence,
+			'updated': updated,
+			'current_text': {},
+			'enabled': {},
+			'stop_indicators': {},
+			'stats': {},
+		}
+		
+		for address in range(displays):
+			enabled, stop_indicator, has_text, length, messages, rejected, telegrams, byte_count, last_send, text = RECORD.unpack_from(data, HEADER.size + address * RECORD.size)
+			status['current_text'][address] = text[:length].decode('utf-8', 'replace') if has_text else None
+			status['enabled'][address] = bool(enabled)
+			status['stop_indicators'][address] = bool(stop_indicator)
+			status['stats'][address] = {
+				'messages': messages,
+				'rejected': rejected,
+				'telegrams': telegrams,
+				'bytes': byte_count,
+				'last_send': last_send,
+			}
+		
+		return status
+	
+	def close(self):
+		self.map.close()
\ No newline at end of file
@@ -0,0 +1,143 @@
+# Copyright (C) 2014 Julian Metzler
+# See the LICENSE file for the full license.
+
+"""
+Optional latency tracing for the client-server system
+"""
+
+import collections
+import itertools
+import threading
+import time
+
+def percentile(values, fraction):
+	"""
+	Return the given percentile (0.0 - 1.0) of a sorted list of values
+	"""
+	
+	if not values:
+		return None
+	
+	index = int(round(fraction * (len(values) - 1)))
+	return values[index]
+
+class Tracer(object):
+	"""
+	Stamps each accepted request with an ID and records the time at which it
+	passes each stage on its way to the serial port.
+	
+	Finished traces are kept in a ring buffer of <size> entries. Each trace is
+	a list of (stage, timestamp) tuples in the order the stages were reached.
+	"""
+	
+	def __init__(self, size = 1000):
+		self.size = size
+		self.traces = collections.deque(maxlen = size)
+		self.active = {}
+		self.lock = threading.Lock()
+		self.counter = itertools.count(1)
+		self.local = threading.local()
+	
+	def start(self, stage = 'accept'):
+		"""
+		Begin a new trace and return its ID
+		"""
+		
+		trace_id = next(self.counter)
+		with self.lock:
+			self.active[trace_id] = [(stage, time.time())]
+		return trace_id
+	
+	def mark(self, trace_id, stage, once = False):
+		"""
+		Record that the given trace has reached the given stage.
+		If <once> is True, a stage the trace has already reached isn't recorded again.
+		"""
+		
+		if trace_id is None:
+			return
+		
+		with self.lock:
+			stamps = self.active.get(trace_id)
+			if stamps is None or (once and any(name == stage for name, timestamp in stamps)):
+				return
+			stamps.append((stage, time.time()))
+	
+	def finish(self, trace_id, stage = None):
+		"""
+		Close a trace and move it into the ring buffer
+		"""
+		
+		if trace_id is None:
+			return
+		
+		now = time.time()
+		with self.lock:
+			stamps = self.active.pop(trace_id, None)
+			if stamps is None:
+				return
+			if stage is not None:
+				stamps.append((stage, now))
+			self.traces.append((trace_id, stamps))
+	
+	def discard(self, trace_id):
+		"""
+		Drop a trace without recording it, e.g. if the request was rejected
+		"""
+		
+		with self.lock:
+			self.active.pop(trace_id, None)
+	
+	def set_current(self, trace_id):
+		"""
+		Set the trace that stages further down in the current thread
+		(e.g. the serial transmission) should be attributed to
+		"""
+		
+		self.local.trace_id = trace_id
+	
+	def get_current(self):
+		return getattr(self.local, 'trace_id', None)
+	
+	def mark_current(self, stage):
+		self.mark(self.get_current(), stage)
+	
+	def get_stage_durations(self):
+		"""
+		Return a dict mapping each stage transition ("a -> b") to a sorted
+		list of durations in seconds, gathered from all finished traces
+		"""
+		
+		with self.lock:
+			traces = list(self.traces)
+		
+		durations = {}
+		for trace_id, stamps in traces:
+			for (stage_a, time_a), (stage_b, time_b) in zip(stamps, stamps[1:]):
+				key = "%s -> %s" % (stage_a, stage_b)
+				durations.setdefault(key, []).append(time_b - time_a)
+			if len(stamps) > 1:
+				key = "%s -> %s" % (stamps[0][0], stamps[-1][0])
+				durations.setdefault("total (%s)" % key, []).append(stamps[-1][1] - stamps[0][1])
+		
+		for values in durations.values():
+			values.sort()
+		
+		return durations
+	
+	def get_histograms(self):
+		"""
+		Return p50, p95 and p99 latencies in milliseconds for each stage transition
+		"""
+		
+		histograms = {}
+		for key, values in self.get_stage_durations().iteritems():
+			histograms[key] = {
+				'count': len(values),
+				'p50': percentile(values, 0.50) * 1000.0,
+				'p95': percentile(values, 0.95) * 1000.0,
+				'p99': percentile(values, 0.99) * 1000.0,
+				'max': values[-1] * 1000.0,
+			}
+		
+		return histograms
\ No newline at end of file
@@ -50,4 +50,34 @@ def prepare_text(message):
 		message = message.decode('utf-8')
 		message = _do_replace(message)
 	
-	return message
\ No newline at end of file
+	return message
+
+def reverse_prepare_text(message):
+	# Undo the character replacements done by prepare_text
+	def _do_replace(message):
+		message = message.replace("{", u"ä")
+		message = message.replace("|", u"ö")
+		message = message.replace("}", u"ü")
+		message = message.replace("~", u"ß")
+		message = message.replace("[", u"Ä")
+		message = message.replace("\\", u"Ö")
+		message = message.replace("]", u"Ü")
+		message = message.encode('utf-8')
+		return message
+	
+	try:
+		message = _do_replace(message)
+	except UnicodeDecodeError:
+		message = message.decode('utf-8')
+		message = _do_replace(message)
+	
+	return message
+
+def checksum(message):
+	# Calculate the IBIS check byte (0x7F XORed with every byte of the message)
+	check_byte = 0x7F
+	
+	for byte in bytearray(message):
+		check_byte ^= byte
+	
+	return chr(check_byte)
\ No newline at end of file
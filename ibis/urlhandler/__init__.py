@@ -0,0 +1,6 @@
+# Copyright (C) 2014 Julian Metzler
+# See the LICENSE file for the full license.
+
+"""
+URL handlers for serial.serial_for_url
+"""
\ No newline at end of file
@@ -0,0 +1,134 @@
+# Copyright (C) 2014 Julian Metzler
+# See the LICENSE file for the full license.
+
+"""
+pySerial URL handler for the virtual IBIS bus (ibisbus://<name>[?options])
+"""
+
+from __future__ import absolute_import
+
+import time
+import urlparse
+
+from serial.serialutil import SerialBase, SerialException, to_bytes, PortNotOpenError
+
+from ..ibis_bus import VirtualBus
+
+class Serial(SerialBase):
+	"""
+	Serial port that writes to a VirtualBus instead of a real device
+	"""
+	
+	def __init__(self, *args, **kwargs):
+		self.bus = None
+		super(Serial, self).__init__(*args, **kwargs)
+	
+	def open(self):
+		if self.is_open:
+			raise SerialException("Port is already open.")
+		
+		if self._port is None:
+			raise SerialException("Port must be configured before it can be used.")
+		
+		self.from_url(self.port)
+		self._reconfigure_port()
+		self.is_open = True
+		self._update_dtr_state()
+		self._update_rts_state()
+	
+	def close(self):
+		self.is_open = False
+		super(Serial, self).close()
+	
+	def _reconfigure_port(self):
+		# The settings are checked by the bus on every write
+		pass
+	
+	def from_url(self, url):
+		parts = urlparse.urlsplit(url)
+		if parts.scheme != "ibisbus":
+			raise SerialException("expected a string in the form \"ibisbus://<name>[?timing={realtime|virtual}][&history=<n>]\": not starting with ibisbus:// (%r)" % parts.scheme)
+		
+		options = {}
+		for option, values in urlparse.parse_qs(parts.query, True).items():
+			if option == 'timing':
+				if values[0] not in ('realtime', 'virtual'):
+					raise SerialException("unknown timing: %r" % values[0])
+				options['realtime'] = values[0] == 'realtime'
+			elif option == 'history':
+				options['history'] = int(values[0])
+			else:
+				raise SerialException("unknown option: %r" % option)
+		
+		name = parts.netloc or parts.path.lstrip("/") or "default"
+		try:
+			self.bus = VirtualBus.get(name, **options)
+		except ValueError as e:
+			raise SerialException(str(e))
+	
+	def get_settings_tuple(self):
+		return (self._baudrate, self._bytesize, self._parity, self._stopbits)
+	
+	def _update_dtr_state(self):
+		if self.bus:
+			self.bus.set_lines(dtr = self._dtr_state)
+	
+	def _update_rts_state(self):
+		if self.bus:
+			self.bus.set_lines(rts = self._rts_state)
+	
+	@property
+	def in_waiting(self):
+		if not self.is_open:
+			raise PortNotOpenError()
+		return 0
+	
+	def read(self, size = 1):
+		"""
+		IBIS displays never reply, so reading just waits for the timeout
+		"""
+		
+		if not self.is_open:
+			raise PortNotOpenError()
+		if self._timeout:
+			time.sleep(self._timeout)
+		return bytes()
+	
+	def write(self, data):
+		if not self.is_open:
+			raise PortNotOpenError()
+		data = to_bytes(data)
+		self.bus.write(data, self.get_settings_tuple())
+		return len(data)
+	
+	def sleep(self, duration):
+		"""
+		Used by IBISMaster to wait for the data to be transmitted
+		"""
+		
+		self.bus.sleep(duration)
+	
+	def reset_input_buffer(self):
+		pass
+	
+	def reset_output_buffer(self):
+		pass
+	
+	def flush(self):
+		pass
+	
+	@property
+	def cts(self):
+		return True
+	
+	@property
+	def dsr(self):
+		return True
+	
+	@property
+	def ri(self):
+		return False
+	
+	@property
+	def cd(self):
+		return True
\ No newline at end of file